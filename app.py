@@ -1,10 +1,24 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, send_file, render_template, Response, stream_with_context
 import yt_dlp
 import os
 import subprocess
 import json
 import re
 import time
+import copy
+import hashlib
+import uuid
+import tempfile
+import shutil
+import threading
+import zipfile
+import array
+import errno
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from urllib.parse import quote
 
 app = Flask(__name__)
 
@@ -14,6 +28,420 @@ TEMP_DIR = 'temp_downloads'
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
 
+# --- Metrics and structured logs ---
+# Counters and histograms live in this process and are rendered in the Prometheus text
+# format at /metrics (the app runs as a single gunicorn worker). Every timed pipeline
+# stage is also written to stdout as one JSON log line.
+STRUCTURED_LOGS = os.environ.get('STRUCTURED_LOGS', '1') == '1'
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = (1e5, 1e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 5e9)
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms, keyed by metric name and label values."""
+
+    def __init__(self):
+        self._meta = OrderedDict() # name -> (type, help, buckets)
+        self._values = {} # name -> {labels: value, or [bucket counts..., sum, count] for histograms}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+        self._values[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    for bound, count in zip(buckets, value):
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {value[-1]}")
+                    lines.append(f"{name}_sum{format_labels(key)} {value[-2]}")
+                    lines.append(f"{name}_count{format_labels(key)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(key):
+    """Render label pairs as {name="value",...}, escaping backslashes, quotes and newlines."""
+    if not key:
+        return ''
+    pairs = []
+    for name, value in key:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+METRICS = Metrics()
+METRICS.describe('cutter_stage_duration_seconds', 'histogram', "Wall time of each pipeline stage.", DURATION_BUCKETS)
+METRICS.describe('cutter_stage_input_bytes', 'histogram', "Bytes downloaded by a pipeline stage.", BYTES_BUCKETS)
+METRICS.describe('cutter_stage_output_bytes', 'histogram', "Bytes written or sent by a pipeline stage.", BYTES_BUCKETS)
+METRICS.describe('cutter_ffmpeg_cpu_seconds', 'histogram', "User + system CPU time of the ffmpeg processes of a stage.", DURATION_BUCKETS)
+METRICS.describe('cutter_job_duration_seconds', 'histogram', "Time from /download to the end of the job, queueing included.", DURATION_BUCKETS)
+METRICS.describe('cutter_jobs_total', 'counter', "Download jobs by output format and outcome.")
+METRICS.describe('cutter_jobs', 'gauge', "Download jobs currently known, by status.")
+METRICS.describe('cutter_scratch_reserved_bytes', 'gauge', "Scratch bytes reserved by running jobs.")
+METRICS.describe('cutter_scratch_used_bytes', 'gauge', "Scratch bytes on disk at the last janitor sweep.")
+METRICS.describe('cutter_scratch_quota_bytes', 'gauge', "Scratch byte quota.")
+METRICS.describe('cutter_scratch_free_bytes', 'gauge', "Free bytes on the scratch volume.")
+METRICS.describe('cutter_scratch_waits_total', 'counter', "Jobs that had to wait for scratch space.")
+METRICS.describe('cutter_scratch_rejections_total', 'counter', "Jobs rejected for lack of scratch space.")
+METRICS.describe('cutter_scratch_removed_dirs_total', 'counter', "Stale job directories removed by recovery and the janitor.")
+METRICS.describe('cutter_info_cache_entries', 'gauge', "Videos in the extract_info cache.")
+METRICS.describe('cutter_info_cache_hits_total', 'counter', "extract_info lookups served from the cache.")
+METRICS.describe('cutter_info_cache_misses_total', 'counter', "extract_info lookups that ran yt-dlp.")
+METRICS.describe('cutter_info_cache_hit_ratio', 'gauge', "Share of extract_info lookups served from the cache.")
+METRICS.describe('cutter_result_cache_entries', 'gauge', "Finished clips in the result cache.")
+METRICS.describe('cutter_result_cache_bytes', 'gauge', "Bytes of finished clips in the result cache.")
+METRICS.describe('cutter_result_cache_max_bytes', 'gauge', "Result cache byte limit.")
+METRICS.describe('cutter_result_cache_hits_total', 'counter', "Jobs served from the result cache.")
+METRICS.describe('cutter_result_cache_misses_total', 'counter', "Jobs that had to produce their clip.")
+METRICS.describe('cutter_result_cache_hit_ratio', 'gauge', "Share of jobs served from the result cache.")
+METRICS.describe('cutter_result_cache_bytes_saved_total', 'counter', "Bytes of clips served from the result cache instead of produced.")
+METRICS.describe('cutter_result_cache_evictions_total', 'counter', "Clips evicted from the result cache.")
+
+def log_event(event, **fields):
+    """Write one structured JSON log line."""
+    if STRUCTURED_LOGS:
+        print(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}), flush=True)
+
+@contextmanager
+def timed_stage(stage, job=None, **labels):
+    """Time a pipeline stage into the metrics and log it.
+
+    The block may fill the yielded dict with bytes_in, bytes_out and cpu_seconds,
+    which are recorded with the duration.
+    """
+    fields = {}
+    outcome = 'ok'
+    started = time.perf_counter()
+    try:
+        yield fields
+    except GeneratorExit:
+        outcome = 'aborted' # A streaming client went away
+        raise
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started, outcome, job, labels, fields)
+
+def record_stage(stage, seconds, outcome, job=None, labels=None, fields=None):
+    """Record one run of a pipeline stage in the metrics and the log."""
+    labels = labels or {}
+    fields = fields or {}
+    METRICS.observe('cutter_stage_duration_seconds', seconds, stage=stage, outcome=outcome, **labels)
+    for field, metric in (('bytes_in', 'cutter_stage_input_bytes'), ('bytes_out', 'cutter_stage_output_bytes'),
+                          ('cpu_seconds', 'cutter_ffmpeg_cpu_seconds')):
+        if fields.get(field) is not None:
+            METRICS.observe(metric, fields[field], stage=stage, **labels)
+    log_event('stage', stage=stage, outcome=outcome, seconds=round(seconds, 3),
+              job_id=job.id if job else None, **labels, **fields)
+
+# --- Pooled YoutubeDL instances ---
+# Creating a YoutubeDL loads the extractor classes and starts with an empty player JS
+# and signature cache, so every fresh instance pays for them again. Each worker keeps
+# a pool of long-lived instances instead. They share one cookie jar and an on-disk
+# cache directory (decrypted signature functions survive restarts and are shared by
+# all workers), and each checkout applies its own format, output template and
+# progress hook, which are reset when the instance goes back to the pool.
+YTDL_POOL_SIZE = int(os.environ.get('YTDL_POOL_SIZE', 8)) # Idle instances kept warm; busy periods create extra ones
+YTDL_POOL_MAX_USES = int(os.environ.get('YTDL_POOL_MAX_USES', 200)) # Recycle an instance after this many checkouts
+YTDL_CACHE_DIR = os.environ.get('YTDL_CACHE_DIR', os.path.join(TEMP_DIR, 'yt-dlp-cache'))
+YTDL_WARMUP_URL = os.environ.get('YTDL_WARMUP_URL') # Extracted once per instance at warm-up to fetch the player JS
+YTDL_BASE_PARAMS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'noprogress': True, # Progress reaches the jobs through hooks, not the log
+    'cachedir': YTDL_CACHE_DIR
+}
+
+class YoutubeDLPool:
+    """Per-process pool of preconfigured YoutubeDL instances with a shared cookie jar."""
+
+    def __init__(self, size, base_params):
+        self.size = size
+        self.base_params = base_params
+        self._idle = [] # Most recently used last, so checkouts get the warmest instance
+        self._lock = threading.Lock()
+        self._cookiejar = None
+        self._hooks = {} # id(ydl) -> progress hooks of the current checkout
+        self._uses = {} # id(ydl) -> checkouts so far
+        self.created = 0
+        self.reused = 0
+
+    def _create(self):
+        ydl = yt_dlp.YoutubeDL(dict(self.base_params))
+        key = id(ydl)
+        ydl.add_progress_hook(lambda d: self._dispatch_progress(key, d))
+        with self._lock:
+            if self._cookiejar is None:
+                self._cookiejar = ydl.cookiejar
+            self.created += 1
+        # cookiejar is a cached property: replace it, and the jar the request handlers were built with
+        ydl.cookiejar = self._cookiejar
+        for handler in ydl._request_director.handlers.values():
+            handler.cookiejar = self._cookiejar
+        ydl.cutter_base_outtmpl = dict(ydl.params['outtmpl'])
+        self._uses[id(ydl)] = 0
+        return ydl
+
+    def _dispatch_progress(self, key, d):
+        for hook in self._hooks.get(key, ()):
+            hook(d)
+
+    def _discard(self, ydl):
+        self._uses.pop(id(ydl), None)
+        ydl.close()
+
+    @contextmanager
+    def checkout(self, progress_hooks=(), **params):
+        """Borrow an instance configured with params (format, outtmpl, ...) for the duration of the block."""
+        with self._lock:
+            ydl = self._idle.pop() if self._idle else None
+            if ydl is not None:
+                self.reused += 1
+        if ydl is None:
+            ydl = self._create()
+        for key, value in params.items():
+            if key == 'outtmpl':
+                ydl.params['outtmpl'] = dict(ydl.cutter_base_outtmpl, default=value)
+            elif key == 'format':
+                ydl.format_selector = ydl.build_format_selector(value)
+            else:
+                ydl.params[key] = value
+        self._hooks[id(ydl)] = list(progress_hooks)
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        finally:
+            self._hooks.pop(id(ydl), None)
+            for key in params:
+                if key in self.base_params:
+                    ydl.params[key] = self.base_params[key]
+                else:
+                    ydl.params.pop(key, None)
+            ydl.params['outtmpl'] = dict(ydl.cutter_base_outtmpl)
+            ydl.format_selector = None
+            self._uses[id(ydl)] += 1
+            # Instances that raised may hold half-finished download state; start those afresh
+            keep = healthy and self._uses[id(ydl)] < YTDL_POOL_MAX_USES
+            with self._lock:
+                if keep and len(self._idle) < self.size:
+                    self._idle.append(ydl)
+                    ydl = None
+            if ydl is not None:
+                self._discard(ydl)
+
+    def warm(self, url=YTDL_WARMUP_URL):
+        """Fill the pool so the first requests of this worker skip instance and extractor startup."""
+        started = time.perf_counter()
+        instances = [self._create() for _ in range(self.size - len(self._idle))]
+        for ydl in instances:
+            ydl.get_info_extractor('Youtube') # Instantiate the extractor (and its player cache) up front
+            if url:
+                try:
+                    ydl.extract_info(url, download=False, process=False)
+                except yt_dlp.utils.YoutubeDLError as e:
+                    print(f"Warm-up extraction failed: {e}")
+        with self._lock:
+            self._idle.extend(instances)
+        log_event('ytdl_pool_warm', instances=len(instances), seconds=round(time.perf_counter() - started, 3))
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'idle': len(self._idle), 'created': self.created, 'reused': self.reused}
+
+YTDL_POOL = YoutubeDLPool(YTDL_POOL_SIZE, YTDL_BASE_PARAMS)
+
+# --- Metadata cache for yt-dlp extract_info ---
+# Extraction costs 1-4 s per call, so the info dict is cached per video and shared
+# by /get_video_info and /download. Entries expire after INFO_CACHE_TTL seconds or
+# shortly before the signed stream URLs inside them expire, whichever comes first.
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', 3600))
+INFO_CACHE_MAX_ENTRIES = int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 256))
+STREAM_URL_EXPIRY_MARGIN = 300 # Drop entries 5 minutes before the stream URLs stop working
+
+YOUTUBE_ID_PATTERN = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/|/v/)([0-9A-Za-z_-]{11})')
+STREAM_EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+
+def normalize_video_id(url):
+    """Return a cache key for a URL: the YouTube video ID when it has one, else the URL itself."""
+    match = YOUTUBE_ID_PATTERN.search(url)
+    if match:
+        return f"youtube:{match.group(1)}"
+    return url.strip()
+
+def stream_urls_expire_at(info):
+    """Return the earliest 'expire' timestamp found in the format URLs, or None."""
+    expiries = []
+    for f in info.get('formats') or []:
+        for key in ('url', 'manifest_url', 'fragment_base_url'):
+            match = STREAM_EXPIRE_PATTERN.search(f.get(key) or '')
+            if match:
+                expiries.append(int(match.group(1)))
+    return min(expiries) if expiries else None
+
+class InfoCache:
+    """Thread-safe TTL + LRU cache of extracted info dicts keyed by normalized video ID."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, info)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key] # Expired
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """Like get, but without counting a hit or miss or refreshing the entry's recency."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] > time.time() else None
+
+    def put(self, key, info):
+        expires_at = time.time() + self.ttl
+        url_expiry = stream_urls_expire_at(info)
+        if url_expiry is not None:
+            expires_at = min(expires_at, url_expiry - STREAM_URL_EXPIRY_MARGIN)
+        with self._lock:
+            self._entries[key] = (expires_at, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) # Evict least recently used
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+INFO_CACHE = InfoCache(INFO_CACHE_MAX_ENTRIES, INFO_CACHE_TTL)
+
+# --- Single-flight request coalescing ---
+# Concurrent callers asking for the same key share one execution: the first one (the
+# leader) runs the work, the others wait for it and get the same result or exception.
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one execution whose outcome all callers share."""
+
+    def __init__(self):
+        self._calls = {} # key -> in-flight call state
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not is_leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+    def stats(self):
+        with self._lock:
+            return {'leaders': self.leaders, 'followers': self.followers, 'in_flight': len(self._calls)}
+
+INFO_FLIGHT = SingleFlight()
+
+def get_cached_info(url):
+    """Return the info dict for a URL, running yt-dlp extraction only on a cache miss.
+
+    Concurrent misses for the same video share a single extraction.
+    """
+    key = normalize_video_id(url)
+    info = INFO_CACHE.get(key)
+    if info is None:
+        info = INFO_FLIGHT.do(key, lambda: extract_and_cache_info(url, key))
+    return info
+
+def extract_and_cache_info(url, key):
+    with timed_stage('extract_info'), YTDL_POOL.checkout(skip_download=True) as ydl:
+        info = ydl.extract_info(url, download=False)
+    # Strip private/runtime keys so the dict can be fed back into process_ie_result
+    info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    INFO_CACHE.put(key, info)
+    return info
+
+def download_with_info(ydl, url, info):
+    """Download through ydl reusing a cached info dict, falling back to a fresh extraction."""
+    if info is not None:
+        try:
+            # process_ie_result mutates the dict, so hand it a private copy
+            return ydl.process_ie_result(copy.deepcopy(info), download=True)
+        except yt_dlp.DownloadError as e:
+            print(f"Download from cached info failed, re-extracting: {e}")
+            INFO_CACHE.invalidate(normalize_video_id(url))
+    return ydl.extract_info(url, download=True)
+
 # Route for the main page (index.html)
 @app.route('/')
 @app.route('/index.html')
@@ -38,6 +466,158 @@ def contact():
 def faq():
     return render_template('faq.html')
 
+# --- Format ranking ---
+# Formats are reduced to compact FormatRow tuples and scored in a single pass. The
+# score order comes from FORMAT_RANKING_POLICY; within it higher bitrate wins and the
+# smaller download breaks ties. Video-only formats are paired with the audio format
+# that needs the least ffmpeg work later (AAC can be stream-copied into MP4).
+TARGET_HEIGHTS = [2160, 1440, 1080, 720, 480, 360, 144] # 4K, 2K, 1080p, 720p, 480p, 360p, 144p
+AUDIO_EXTS = ('m4a', 'opus', 'aac', 'mp3') # Prefer common or high-quality audio formats
+MP4_COPY_VIDEO_CODECS = ('avc1', 'h264') # Video codecs that stay stream-copyable (also by smart cut)
+MP4_COPY_AUDIO_CODECS = ('mp4a', 'aac') # Audio codecs that can be copied into MP4 without re-encoding
+FORMAT_RANKING_POLICY = {
+    'prefer_combined': True, # A combined format needs no separate audio download or merge
+    'prefer_mp4_copy': True, # Copyable codecs avoid re-encoding when merging into MP4
+    'max_fps': 60 # Frame rates above this are not preferred any further
+}
+
+FormatRow = namedtuple('FormatRow', 'format_id ext height fps vcodec acodec tbr abr filesize size_is_estimate')
+
+def compact_format(f, duration):
+    """Reduce a yt-dlp format dict to a FormatRow, estimating a missing size from tbr x duration."""
+    filesize = f.get('filesize') or f.get('filesize_approx')
+    size_is_estimate = False
+    if not filesize and f.get('tbr') and duration:
+        filesize = f['tbr'] * 1000 / 8 * duration # tbr is in kbit/s
+        size_is_estimate = True
+    return FormatRow(
+        f.get('format_id'), f.get('ext'), f.get('height'), f.get('fps') or 0,
+        f.get('vcodec') or 'none', f.get('acodec') or 'none',
+        f.get('tbr') or 0, f.get('abr') or 0, filesize, size_is_estimate
+    )
+
+def video_score(row, policy):
+    return (
+        policy['prefer_combined'] and row.acodec != 'none',
+        policy['prefer_mp4_copy'] and row.vcodec.startswith(MP4_COPY_VIDEO_CODECS),
+        min(row.fps, policy['max_fps']),
+        row.tbr,
+        -(row.filesize or float('inf'))
+    )
+
+def audio_score(row, policy, for_mp4):
+    return (
+        for_mp4 and policy['prefer_mp4_copy'] and row.acodec.startswith(MP4_COPY_AUDIO_CODECS),
+        row.abr or row.tbr,
+        -(row.filesize or float('inf'))
+    )
+
+def format_size(size, is_estimate):
+    if not size:
+        return "Unknown size"
+    return f"{'~' if is_estimate else ''}{round(size / (1024*1024), 2)} MB"
+
+def rank_formats(info, policy=FORMAT_RANKING_POLICY):
+    """Return the /get_video_info format list: the best format per target height, best audio last."""
+    duration = info.get('duration')
+    best_video = {} # height -> (score, row)
+    best_audio = None # (score, row) for audio downloads (MP3)
+    best_merge_audio = None # (score, row) to pair with video-only formats
+
+    for f in info.get('formats') or []:
+        row = compact_format(f, duration)
+        if row.vcodec == 'none' and row.acodec != 'none':
+            if row.ext in AUDIO_EXTS:
+                score = audio_score(row, policy, for_mp4=False)
+                if best_audio is None or score > best_audio[0]:
+                    best_audio = (score, row)
+                score = audio_score(row, policy, for_mp4=True)
+                if best_merge_audio is None or score > best_merge_audio[0]:
+                    best_merge_audio = (score, row)
+        elif row.vcodec != 'none' and row.height in TARGET_HEIGHTS:
+            score = video_score(row, policy)
+            if row.height not in best_video or score > best_video[row.height][0]:
+                best_video[row.height] = (score, row)
+
+    final_formats_list = []
+    # Add video formats in descending order of resolution
+    for height in TARGET_HEIGHTS:
+        if height not in best_video:
+            continue
+        row = best_video[height][1]
+        is_video_only = row.acodec == 'none'
+        entry = {
+            'id': row.format_id,
+            'quality': f"Video / {height}p",
+            'format_type': "mp4", # Assume mp4 for video type
+            'is_video_only': is_video_only # Video-only formats need audio merging
+        }
+        size, is_estimate = row.filesize, row.size_is_estimate
+        if is_video_only and best_merge_audio:
+            audio_row = best_merge_audio[1]
+            entry['audio_id'] = audio_row.format_id
+            if size and audio_row.filesize:
+                size += audio_row.filesize
+                is_estimate = is_estimate or audio_row.size_is_estimate
+        entry['fileSize'] = format_size(size, is_estimate)
+        final_formats_list.append(entry)
+
+    # Add the best audio format if found
+    if best_audio:
+        row = best_audio[1]
+        final_formats_list.append({
+            'id': row.format_id,
+            'quality': f"Audio / {row.ext.upper()}",
+            'fileSize': format_size(row.filesize, row.size_is_estimate),
+            'format_type': "mp3", # Assume mp3 as general final audio type
+            'is_video_only': False
+        })
+    return final_formats_list
+
+def audio_is_mp4_copyable(info, audio_format_id):
+    """True when the chosen audio format can be stream-copied into an MP4."""
+    for f in (info or {}).get('formats') or []:
+        if f.get('format_id') == audio_format_id:
+            return (f.get('acodec') or '').startswith(MP4_COPY_AUDIO_CODECS)
+    return False
+
+# Route exposing cache counters (hits, misses, size)
+@app.route('/cache_stats')
+def cache_stats():
+    with JOBS_LOCK:
+        download_flights = dict(DOWNLOAD_FLIGHT_STATS, in_flight=len(DOWNLOAD_FLIGHTS))
+    return jsonify({
+        "info_cache": INFO_CACHE.stats(),
+        "result_cache": RESULT_CACHE.stats(),
+        "scratch": SCRATCH.stats(),
+        "ytdl_pool": YTDL_POOL.stats(),
+        "single_flight": {"info": INFO_FLIGHT.stats(), "download": download_flights, "preview": preview_build_stats()}
+    }), 200
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def metrics():
+    with JOBS_LOCK:
+        statuses = [job.status for job in JOBS.values()]
+    for status in ('queued', 'running', 'ready', 'finished', 'failed'):
+        METRICS.set('cutter_jobs', statuses.count(status), status=status)
+    scratch = SCRATCH.stats()
+    for field in ('reserved_bytes', 'used_bytes', 'quota_bytes', 'free_bytes'):
+        METRICS.set(f'cutter_scratch_{field}', scratch[field])
+    for field in ('waits', 'rejections', 'removed_dirs'):
+        METRICS.set(f'cutter_scratch_{field}_total', scratch[field])
+    # The cache counters only grow, so they are exported as counters from their totals
+    for prefix, stats, gauges, counters in (
+        ('cutter_info_cache', INFO_CACHE.stats(), ('entries', 'hit_ratio'), ('hits', 'misses')),
+        ('cutter_result_cache', RESULT_CACHE.stats(), ('entries', 'bytes', 'max_bytes', 'hit_ratio'),
+         ('hits', 'misses', 'bytes_saved', 'evictions'))
+    ):
+        for field in gauges:
+            METRICS.set(f'{prefix}_{field}', stats[field])
+        for field in counters:
+            METRICS.set(f'{prefix}_{field}_total', stats[field])
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
 # Route to fetch video information and filtered formats
 @app.route('/get_video_info', methods=['POST'])
 def get_video_info():
@@ -46,99 +626,15 @@ def get_video_info():
 
     if not url:
         return jsonify({"error": "URL is required"}), 400
+    response_data, status = video_info_payload(url)
+    return jsonify(response_data), status
 
+def video_info_payload(url):
+    """Body and status of a /get_video_info response (shared with the ASGI entry point)."""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'skip_download': True,
-            'dump_single_json': True,
-            'no_warnings': True,
-            'listformats': False
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-
-        available_formats = {} # To store the best format for each quality (video+audio or video-only)
-        best_audio_format = None
-
-        # Target qualities in descending order
-        target_heights = [2160, 1440, 1080, 720, 480, 360, 144] # 4K, 2K, 1080p, 720p, 480p, 360p, 144p
+        info = get_cached_info(url)
 
-        for f in info.get('formats', []):
-            format_id = f.get('format_id')
-            ext = f.get('ext')
-            height = f.get('height')
-            vcodec = f.get('vcodec')
-            acodec = f.get('acodec')
-            filesize = f.get('filesize') or f.get('filesize_approx')
-
-            if filesize is None: # Ignore formats with no known file size
-                continue
-            
-            # Find the best audio format
-            if acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
-                # Prefer common or high-quality audio formats
-                if ext in ['m4a', 'opus', 'aac', 'mp3']:
-                    if best_audio_format is None or filesize > (best_audio_format.get('filesize') or 0):
-                        best_audio_format = {
-                            'id': format_id,
-                            'quality': f"Audio / {ext.upper()}",
-                            'fileSize': f"{round(filesize / (1024*1024), 2)} MB",
-                            'format_type': "mp3", # Assume mp3 as general final audio type
-                            'is_video_only': False
-                        }
-            
-            # Find main video formats
-            if vcodec and vcodec != 'none' and height in target_heights:
-                # If we find a combined video+audio format for this resolution, prioritize it
-                if acodec and acodec != 'none':
-                    if height not in available_formats or available_formats[height].get('is_video_only', False):
-                        available_formats[height] = {
-                            'id': format_id,
-                            'quality': f"Video / {height}p",
-                            'fileSize': f"{round(filesize / (1024*1024), 2)} MB",
-                            'format_type': "mp4", # Assume mp4 for video type
-                            'is_video_only': False # This means it's combined
-                        }
-                # If it's video-only and we haven't found a combined format for this resolution yet, record it
-                elif height not in available_formats: # Don't record video-only if a combined format already exists
-                    available_formats[height] = {
-                        'id': format_id,
-                        'quality': f"Video / {height}p",
-                        'fileSize': f"{round(filesize / (1024*1024), 2)} MB",
-                        'format_type': "mp4",
-                        'is_video_only': True # This means it's video-only and needs audio merging
-                    }
-                # If we already have a format for this resolution but the current format is better (larger file size)
-                elif filesize > (available_formats[height].get('filesize') or 0):
-                     # Always prefer combined format over video-only if available
-                     if acodec and acodec != 'none':
-                         available_formats[height] = {
-                            'id': format_id,
-                            'quality': f"Video / {height}p",
-                            'fileSize': f"{round(filesize / (1024*1024), 2)} MB",
-                            'format_type': "mp4",
-                            'is_video_only': False
-                        }
-                     elif available_formats[height].get('is_video_only', False): # If current is video-only and new is video-only and larger
-                         available_formats[height] = {
-                            'id': format_id,
-                            'quality': f"Video / {height}p",
-                            'fileSize': f"{round(filesize / (1024*1024), 2)} MB",
-                            'format_type': "mp4",
-                            'is_video_only': True
-                        }
-
-        final_formats_list = []
-        # Add video formats in descending order of resolution
-        for h in target_heights:
-            if h in available_formats:
-                final_formats_list.append(available_formats[h])
-        
-        # Add the best audio format if found
-        if best_audio_format:
-            final_formats_list.append(best_audio_format)
+        final_formats_list = rank_formats(info)
 
         response_data = {
             "title": info.get('title'),
@@ -146,292 +642,2075 @@ def get_video_info():
             "thumbnail": info.get('thumbnail'),
             "formats": final_formats_list
         }
-        return jsonify(response_data), 200
+        return response_data, 200
     except yt_dlp.DownloadError as e:
-        return jsonify({"error": f"Could not get video info: {str(e)}"}), 500
+        return {"error": f"Could not get video info: {str(e)}"}, 500
     except Exception as e:
         print(f"Server error in get_video_info: {e}")
-        return jsonify({"error": "An internal server error occurred."}), 500
+        return {"error": "An internal server error occurred."}, 500
+
+# --- Background download jobs ---
+# /download only validates the request and queues a job; the yt-dlp/ffmpeg pipeline
+# runs on a bounded thread pool and the browser polls /jobs/<id> for progress.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+FFMPEG_CONCURRENCY = int(os.environ.get('FFMPEG_CONCURRENCY', 2)) # Max ffmpeg processes running at once
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 3600)) # Seconds a finished job (and its file) is kept
+STREAM_CLAIM_TIMEOUT = int(os.environ.get('STREAM_CLAIM_TIMEOUT', 30)) # Seconds a ready stream waits for its client
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', 4)) # Parallel fragments per DASH/HLS download
+
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='download-job')
+# Audio streams of video-only formats download here while the job thread fetches the video.
+# A separate pool, so a job never waits on a slot held by another job of JOB_EXECUTOR.
+STREAM_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='stream-download')
+FFMPEG_SLOTS = threading.BoundedSemaphore(FFMPEG_CONCURRENCY)
+JOBS = {} # job_id -> DownloadJob
+JOBS_LOCK = threading.Lock()
+
+# Relative weight of each pipeline stage in the overall progress bar
+STAGE_WEIGHTS = {
+    'download_video': 4,
+    'download_audio': 1,
+    'fetch_range': 4,
+    'transcode': 2
+}
+
+class DownloadJob:
+    """State of one /download request, shared between the worker thread and the polling routes."""
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = 'queued' # queued -> running -> finished | ready (to stream) | failed
+        self.stage = 'queued'
+        self.progress = 0.0
+        self.error = None
+        self.file_path = None
+        self.output_filename_base = None
+        self.work_dir = None # Private directory for this job's intermediate files
+        self.download_name = None
+        self.stream_command = None # Final ffmpeg command run by /jobs/<id>/stream
+        self.operations = None # What the ffmpeg stage does, e.g. 'merge+trim' (metric label)
+        self.ffmpeg_cpu_seconds = 0.0
+        self.cache_key = None
+        self.leader = None # Job producing the same output that this one is coalesced onto
+        self.followers = []
+        self.created_at = time.time()
+        self.finished_at = None
+        self._steps = []
+        self._fractions = {}
+        self._lock = threading.Lock()
+
+    def plan_stages(self, stages):
+        """Declare the stages this job will run so progress can be weighted across them.
+
+        A tuple of stage names is one step whose stages run concurrently.
+        """
+        with self._lock:
+            self._steps = [step if isinstance(step, tuple) else (step,) for step in stages]
+            self._fractions = {}
+
+    def report(self, stage, fraction):
+        """Record progress (0..1) of the given stage and recompute the overall progress."""
+        fraction = max(0.0, min(1.0, fraction))
+        with self._lock:
+            planned = [s for step in self._steps for s in step]
+            if stage in planned:
+                # Reaching a stage means every step planned before it is complete
+                for step in self._steps:
+                    if stage in step:
+                        break
+                    self._fractions.update(dict.fromkeys(step, 1.0))
+                self._fractions[stage] = fraction
+            self.stage = stage
+            total = sum(STAGE_WEIGHTS.get(s, 1) for s in planned) or 1
+            overall = sum(STAGE_WEIGHTS.get(s, 1) * f for s, f in self._fractions.items()) / total
+            self.progress = max(self.progress, min(overall, 0.99)) # 100% is reserved for 'finished'
+
+    def to_dict(self):
+        leader = self.leader
+        if leader is not None:
+            # Coalesced jobs report the progress of the job doing the work
+            with leader._lock:
+                stage, progress = leader.stage, min(leader.progress, 0.99)
+        else:
+            stage, progress = self.stage, self.progress
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'stage': stage,
+                'progress': round(progress * 100, 1),
+                'error': self.error,
+                'file_name': self.download_name or (os.path.basename(self.file_path) if self.file_path else None),
+                'delivery': 'stream' if self.stream_command else 'file'
+            }
+
+def ydl_progress_hook(job, stage):
+    """Build a yt-dlp progress hook that forwards download progress to the job."""
+    def hook(d):
+        if d.get('status') == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                job.report(stage, d.get('downloaded_bytes', 0) / total)
+        elif d.get('status') == 'finished':
+            job.report(stage, 1.0)
+    return hook
+
+def download_stream(job, url, info, format_spec, outtmpl, stage):
+    """Download one format of url with yt-dlp, reporting progress as stage. Returns the downloaded file path."""
+    job.report(stage, 0.0)
+    with timed_stage(stage, job) as timing, YTDL_POOL.checkout(
+        format=format_spec,
+        outtmpl=outtmpl,
+        concurrent_fragment_downloads=FRAGMENT_CONCURRENCY,
+        progress_hooks=[ydl_progress_hook(job, stage)]
+    ) as ydl:
+        downloaded_info = download_with_info(ydl, url, info)
+        path = ydl.prepare_filename(downloaded_info)
+        timing['bytes_in'] = os.path.getsize(path) if os.path.exists(path) else None
+        return path
+
+def wait_with_rusage(process):
+    """Reap a Popen child like process.wait(), returning (returncode, CPU seconds of user + system time)."""
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+def run_ffmpeg(command, job, stage, duration=None):
+    """Run an ffmpeg command under the global concurrency cap, reporting -progress output to the job.
+
+    Raises subprocess.CalledProcessError on failure, like subprocess.run(check=True).
+    """
+    # Ask ffmpeg for machine-readable progress on stdout
+    command = [command[0], '-progress', 'pipe:1', '-nostats'] + command[1:]
+    with FFMPEG_SLOTS:
+        job.report(stage, 0.0)
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+            for raw_line in process.stdout:
+                key, _, value = raw_line.decode(errors='replace').strip().partition('=')
+                # out_time_ms is (despite its name) in microseconds, like out_time_us
+                if key in ('out_time_us', 'out_time_ms') and duration and value.isdigit():
+                    job.report(stage, int(value) / 1000000 / duration)
+            returncode, cpu_seconds = wait_with_rusage(process)
+            job.ffmpeg_cpu_seconds += cpu_seconds
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output=b'', stderr=stderr)
+    job.report(stage, 1.0)
+
+# --- Range fetch: read only the requested time window from the remote stream ---
+# When a trim window is set, ffmpeg seeks inside the remote stream URL(s) with HTTP
+# range requests instead of yt-dlp downloading the whole video first. The command
+# is planned exactly like the one used on local files, so the output is the same.
+RANGE_FETCH = os.environ.get('RANGE_FETCH', '1') == '1'
+RANGE_FETCH_PROTOCOLS = ('https', 'http', 'm3u8', 'm3u8_native') # Protocols ffmpeg can seek in directly
+AUDIO_FORMAT_SPEC = 'bestaudio[ext=m4a]/bestaudio[ext=opus]/bestaudio' # Prefer m4a or opus
+
+def resolve_streams(info, format_spec):
+    """Run yt-dlp format selection on a cached info dict and return the chosen format dicts."""
+    with YTDL_POOL.checkout(format=format_spec) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    return selected.get('requested_formats') or [selected]
+
+def range_fetch_sources(info, format_id, download_format, is_video_only, audio_spec=AUDIO_FORMAT_SPEC):
+    """Return the remote (url, http_headers) inputs for a range fetch, or None if not possible.
+
+    The list holds the video source first (omitted for MP3) and the audio source last.
+    """
+    if info is None:
+        return None
+    try:
+        if is_video_only and download_format == 'mp3':
+            streams = resolve_streams(info, audio_spec)
+        elif is_video_only:
+            streams = resolve_streams(info, f"{format_id}+{audio_spec}")
+        else:
+            streams = resolve_streams(info, format_id)
+    except yt_dlp.DownloadError as e:
+        print(f"Range fetch format selection failed: {e}")
+        return None
+    if not all(f.get('url') and f.get('protocol') in RANGE_FETCH_PROTOCOLS for f in streams):
+        return None
+    return [(f['url'], f.get('http_headers')) for f in streams]
+
+# --- Encoding profiles ---
+# Named x264/audio settings for every encode; 'balanced' is what every job used before.
+# 'adaptive' is resolved when a job is queued: under load (1-minute load average per
+# core, or the job backlog per ffmpeg slot) and for long high-resolution clips it picks
+# 'latency', and it caps -threads so that the ffmpeg slots share the cores instead of
+# each one starting a thread per core. Preset, CRF and audio bitrate are part of the
+# result cache key; the thread count is not, as it does not change the clip in any way
+# a viewer could tell.
+EncodingProfile = namedtuple('EncodingProfile', 'preset crf threads audio_bitrate') # threads None = ffmpeg default
+ENCODING_PROFILES = {
+    'latency': EncodingProfile('veryfast', '25', None, '128k'),
+    'balanced': EncodingProfile('fast', '23', None, '192k'),
+    'quality': EncodingProfile('slow', '20', None, '256k')
+}
+ENCODING_PROFILE = os.environ.get('ENCODING_PROFILE', 'balanced') # Default for requests that name none
+ADAPTIVE_HIGH_LOAD = float(os.environ.get('ADAPTIVE_HIGH_LOAD', 1.0))
+ADAPTIVE_HEAVY_CLIP_SECONDS = 1800 # Clip length x height / 720p above which a clip counts as heavy
+
+def current_load():
+    """How busy the host is: the larger of the load average per core and the job backlog per ffmpeg slot."""
+    try:
+        cpu_load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        cpu_load = 0.0
+    with JOBS_LOCK:
+        backlog = sum(1 for job in JOBS.values() if job.status in ('queued', 'running'))
+    return max(cpu_load, backlog / FFMPEG_CONCURRENCY)
+
+def choose_encoding(profile_name, clip_seconds=None, height=None):
+    """Resolve a requested profile ('adaptive' included) to (profile name, thread cap or None)."""
+    if profile_name != 'adaptive':
+        return profile_name, None
+    load = current_load()
+    heavy = bool(clip_seconds) and clip_seconds * (height or 720) / 720 > ADAPTIVE_HEAVY_CLIP_SECONDS
+    busy = load >= ADAPTIVE_HIGH_LOAD / 2
+    name = 'latency' if load >= ADAPTIVE_HIGH_LOAD or (heavy and busy) else 'balanced'
+    # Share the cores between the ffmpeg slots rather than letting every encode use all of them
+    threads = max(1, (os.cpu_count() or 1) // FFMPEG_CONCURRENCY) if busy else None
+    return name, threads
+
+def format_height(info, format_id):
+    """Height of format_id in info, or None when either is unknown."""
+    for f in (info or {}).get('formats') or []:
+        if f.get('format_id') == format_id:
+            return f.get('height')
+    return None
+
+def job_encoding(params):
+    """The EncodingProfile a job was queued with."""
+    profile = ENCODING_PROFILES[params.get('encoding_profile') or 'balanced']
+    return profile._replace(threads=params.get('encoder_threads') or profile.threads)
+
+def x264_options(encoding):
+    options = ['-c:v', 'libx264', '-preset', encoding.preset, '-crf', encoding.crf]
+    if encoding.threads:
+        options += ['-threads', str(encoding.threads)]
+    return options
+
+def format_http_headers(headers):
+    """Render yt-dlp http_headers as the value of ffmpeg's -headers option."""
+    return ''.join(f"{k}: {v}\r\n" for k, v in headers.items())
+
+def plan_ffmpeg_pipeline(sources, download_format, is_video_only, start_time_str, duration, output_path, trim_mode='precise', streaming=False, copy_audio=False, encoding=ENCODING_PROFILES['balanced']):
+    """Build the one ffmpeg command that turns the sources into the requested output.
+
+    sources holds (path_or_url, http_headers) pairs, headers being None for local files:
+    the video source first (absent for an MP3 cut from a video-only format) and the
+    audio source last. Each output stream is decoded and encoded at most once and
+    no-op steps are left out. Returns None when the single source can be served as-is.
+    With trim_mode 'keyframe' the video of a cut is stream-copied from the keyframe
+    before the start instead of re-encoded. With streaming the output is written to
+    output_path as a non-seekable stream (fragmented MP4 for video), e.g. 'pipe:1'.
+    With copy_audio an uncut merge stream-copies the (AAC) audio too. encoding is the
+    EncodingProfile for the x264 and audio encoders.
+    """
+    trim = start_time_str is not None and duration is not None
+    merge = download_format == 'mp4' and is_video_only and len(sources) > 1
+    if download_format == 'mp4' and not trim and not merge:
+        return None
+
+    command = ['ffmpeg']
+    for location, headers in sources:
+        if headers:
+            command += ['-headers', format_http_headers(headers)]
+        if trim:
+            command += ['-ss', start_time_str] # وضع -ss قبل -i لتسريع العملية
+        command += ['-i', location]
+    if trim:
+        command += ['-t', str(duration)] # استخدام -t بدلاً من -to لتجنب مشاكل التوقيت
+    audio_input = len(sources) - 1
+
+    if download_format == 'mp3':
+        command += [
+            '-map', f'{audio_input}:a:0', # Map only the audio stream
+            '-vn', # No video
+            '-c:a', 'libmp3lame',
+            '-b:a', encoding.audio_bitrate,
+        ]
+    else:
+        command += ['-map', '0:v:0', '-map', f'{audio_input}:a:0']
+        if trim and trim_mode != 'keyframe':
+            # للفيديو: حل هجين لتوازن السرعة والجودة
+            command += x264_options(encoding) # إعادة ترميز الفيديو لحل مشاكل الـ keyframes
+        else:
+            command += ['-c:v', 'copy'] # Plain merge or keyframe cut, the video stream is kept as-is
+        if copy_audio and not trim:
+            command += ['-c:a', 'copy']
+        else:
+            command += [
+                '-c:a', 'aac',
+                '-b:a', encoding.audio_bitrate,
+            ]
+        if streaming:
+            # The moov atom cannot be rewritten on a pipe, so write a fragmented MP4 instead
+            command += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+        else:
+            command += ['-movflags', '+faststart']  # تحسين للتشغيل السريع
+        if merge:
+            command += ['-shortest']
+    if trim:
+        command += ['-avoid_negative_ts', 'make_zero']  # تجنب مشاكل الـ timestamps
+    if streaming:
+        command += ['-f', download_format] # No file extension to guess the muxer from
+    command += ['-y', output_path]
+    return command
+
+# --- Smart cut: re-encode only the partial GOPs at the edges of an MP4 cut ---
+# 'precise'  re-encodes the whole clip (frame accurate, most CPU)
+# 'smart'    re-encodes from start to the first keyframe and from the last keyframe to end,
+#            stream-copies everything in between (frame accurate, H.264 sources only)
+# 'keyframe' stream-copies from the keyframe before start (no video encoding, not frame accurate)
+TRIM_MODES = ('precise', 'smart', 'keyframe')
+TRIM_MODE = os.environ.get('TRIM_MODE', 'precise')
+
+# ffprobe profile names -> libx264 -profile:v values, so re-encoded edges match the copied middle
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high'
+}
+
+def probe_keyframes(source, start_sec, end_sec):
+    """Return (stream, keyframes) for the first video stream of a (path_or_url, http_headers) source.
+
+    stream holds codec_name/profile/pix_fmt, keyframes the sorted keyframe times (seconds from the
+    start of the file) around the window, found from packet flags without decoding.
+    """
+    location, headers = source
+    command = ['ffprobe', '-v', 'error']
+    if headers:
+        command += ['-headers', format_http_headers(headers)]
+    command += [
+        '-select_streams', 'v:0',
+        '-read_intervals', f"{max(start_sec - 1, 0)}%{end_sec + 1}",
+        '-show_entries', 'stream=codec_name,profile,pix_fmt:packet=pts_time,flags:format=start_time',
+        '-of', 'json',
+        location
+    ]
+    result = subprocess.run(command, check=True, capture_output=True)
+    data = json.loads(result.stdout)
+    file_start = float((data.get('format') or {}).get('start_time') or 0)
+    keyframes = sorted(
+        float(packet['pts_time']) - file_start
+        for packet in data.get('packets', [])
+        if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')
+    )
+    streams = data.get('streams') or [{}]
+    return streams[0], keyframes
+
+def smart_cut(job, sources, trim_window, output_path, stage, encoding=ENCODING_PROFILES['balanced']):
+    """Frame-accurate MP4 cut that re-encodes only the GOP edges and stream-copies the middle.
+
+    Returns False without writing anything when the source is not suitable (not H.264, or no
+    whole GOP inside the window), so the caller can fall back to a precise re-encode.
+    """
+    start_sec, end_sec = trim_window
+    video_source, audio_source = sources[0], sources[-1]
+    try:
+        stream, keyframes = probe_keyframes(video_source, start_sec, end_sec)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        print(f"Keyframe probe failed, falling back to a precise re-encode: {e}")
+        return False
+    if stream.get('codec_name') != 'h264':
+        # Re-encoded edges are H.264, so the copied middle has to be H.264 as well
+        print(f"Smart cut needs an H.264 source (got {stream.get('codec_name')}), using a precise re-encode.")
+        return False
+    inner_keyframes = [t for t in keyframes if start_sec <= t <= end_sec]
+    if len(inner_keyframes) < 2:
+        print("No whole GOP inside the cut, using a precise re-encode.")
+        return False
+    first_keyframe, last_keyframe = inner_keyframes[0], inner_keyframes[-1]
+
+    segments = [] # (name, start, end, reencode)
+    if first_keyframe > start_sec:
+        segments.append(('head', start_sec, first_keyframe, True))
+    segments.append(('middle', first_keyframe, last_keyframe, False))
+    if end_sec > last_keyframe:
+        segments.append(('tail', last_keyframe, end_sec, True))
+    print(f"Smart cut: re-encoding {first_keyframe - start_sec:.2f}s + {end_sec - last_keyframe:.2f}s, copying {last_keyframe - first_keyframe:.2f}s")
+
+    work_dir = tempfile.mkdtemp(prefix='smartcut_', dir=job.work_dir or TEMP_DIR)
+    try:
+        location, headers = video_source
+        for name, segment_start, segment_end, reencode in segments:
+            command = ['ffmpeg']
+            if headers:
+                command += ['-headers', format_http_headers(headers)]
+            command += [
+                '-ss', f"{segment_start:.6f}",
+                '-i', location,
+                '-t', f"{segment_end - segment_start:.6f}",
+                '-map', '0:v:0',
+                '-an'
+            ]
+            if reencode:
+                command += x264_options(encoding) + ['-pix_fmt', stream.get('pix_fmt') or 'yuv420p']
+                if stream.get('profile') in X264_PROFILES:
+                    command += ['-profile:v', X264_PROFILES[stream['profile']]]
+            else:
+                # Input seeking lands exactly on the keyframe, so the copy starts clean
+                command += ['-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb']
+            # MPEG-TS keeps SPS/PPS in-band, so segments from different encoders concatenate cleanly
+            command += ['-f', 'mpegts', '-y', os.path.join(work_dir, f"{name}.ts")]
+            run_ffmpeg(command, job, stage)
+
+        list_path = os.path.join(work_dir, 'segments.txt')
+        with open(list_path, 'w') as list_file:
+            for name, *_ in segments:
+                list_file.write(f"file '{name}.ts'\n")
+
+        location, headers = audio_source
+        concat_command = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if headers:
+            concat_command += ['-headers', format_http_headers(headers)]
+        concat_command += [
+            '-ss', f"{start_sec:.6f}",
+            '-i', location,
+            '-t', f"{end_sec - start_sec:.6f}",
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-b:a', encoding.audio_bitrate,
+            '-movflags', '+faststart',
+            '-y',
+            output_path
+        ]
+        run_ffmpeg(concat_command, job, stage, end_sec - start_sec)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return True
+
+def time_to_seconds(time_str):
+    parts = list(map(int, time_str.split(':')))
+    if len(parts) == 3: return parts[0] * 3600 + parts[1] * 60 + parts[2]
+    if len(parts) == 2: return parts[0] * 60 + parts[1]
+    return 0
+
+# --- Scratch storage ---
+# Every job gets a private directory under SCRATCH_DIR (point it at a tmpfs such as
+# /dev/shm/cutter or at a dedicated volume; finished files are then copied into
+# RESULT_CACHE_DIR rather than renamed), so cleanup never guesses file names:
+# whatever yt-dlp or ffmpeg leave behind (.part, .ytdl, .f137.mp4, ...) goes with the
+# directory. Jobs reserve their expected size against SCRATCH_QUOTA_BYTES before they
+# start and wait (up to SCRATCH_ADMISSION_WAIT seconds) while the quota is used up.
+# Each directory records the pid of the worker that owns it, so a restarted worker
+# can remove what a crashed or killed one left without touching live siblings, and a
+# janitor thread removes directories older than SCRATCH_MAX_AGE.
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR', os.path.join(TEMP_DIR, 'jobs'))
+SCRATCH_QUOTA_BYTES = int(os.environ.get('SCRATCH_QUOTA_BYTES', 10 * 1024 ** 3))
+SCRATCH_MIN_FREE_BYTES = int(os.environ.get('SCRATCH_MIN_FREE_BYTES', 1024 ** 3)) # Never fill the volume past this
+SCRATCH_DEFAULT_RESERVATION = int(os.environ.get('SCRATCH_DEFAULT_RESERVATION', 512 * 1024 ** 2)) # When sizes are unknown
+SCRATCH_ADMISSION_WAIT = int(os.environ.get('SCRATCH_ADMISSION_WAIT', 300))
+SCRATCH_MAX_AGE = int(os.environ.get('SCRATCH_MAX_AGE', 6 * 3600))
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 60))
+SCRATCH_OWNER_FILE = '.owner'
+
+class StorageFull(Exception):
+    """No scratch space could be reserved for a job."""
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Exists, owned by someone else
+    return True
+
+def temp_owner(name):
+    """The pid of the worker writing a '<key>.tmp-<pid>-<uuid>' entry, or None if the name has none."""
+    try:
+        return int(name.split('.tmp-', 1)[1].split('-', 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+def tree_size_and_mtime(path):
+    """Total size and newest modification time of the files below path."""
+    size, newest = 0, os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue # Removed while walking
+            size += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    return size, newest
+
+class ScratchStorage:
+    """Per-job scratch directories under a byte quota, with crash recovery and a background janitor."""
+
+    def __init__(self, directory, quota_bytes, min_free_bytes, max_age):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_age = max_age
+        self._reservations = {} # job id -> reserved bytes
+        self._cond = threading.Condition()
+        self.used_bytes = 0 # Measured by the janitor
+        self.waits = 0
+        self.rejections = 0
+        self.removed_dirs = 0
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def _owner(self, path):
+        try:
+            with open(os.path.join(path, SCRATCH_OWNER_FILE)) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _remove(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+        self.removed_dirs += 1
+
+    def recover(self):
+        """Remove leftovers of dead workers (killed by a timeout, OOM or crash) at startup."""
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                os.remove(path)
+                continue
+            owner = self._owner(path)
+            # Our own pid can only appear here if a previous process had it (e.g. after a container restart)
+            if owner is None or owner == os.getpid() or not pid_alive(owner):
+                self._remove(path)
+                removed += 1
+        if removed:
+            print(f"Removed {removed} job directories left by a previous run")
+
+    def has_room(self, size):
+        reserved = sum(self._reservations.values())
+        if reserved + size > self.quota_bytes:
+            return False
+        return shutil.disk_usage(self.directory).free - size >= self.min_free_bytes
+
+    def is_full(self):
+        """True when the scratch volume is already below its free-space floor."""
+        return shutil.disk_usage(self.directory).free < self.min_free_bytes
+
+    def allocate(self, job, size, timeout=SCRATCH_ADMISSION_WAIT):
+        """Reserve size bytes for the job, waiting for space if needed, and create its directory.
+
+        Raises StorageFull when the job can never fit or no space frees up within timeout.
+        """
+        if size > self.quota_bytes:
+            self.rejections += 1
+            raise StorageFull("This download needs more temporary space than the server allows.")
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if not self.has_room(size):
+                self.waits += 1
+                job.stage = 'waiting_for_storage'
+            while not self.has_room(size):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejections += 1
+                    raise StorageFull("The server is out of temporary storage, please try again later.")
+                # Also wake up periodically: space can be freed by other processes
+                self._cond.wait(min(remaining, 5))
+            self._reservations[job.id] = size
+        path = os.path.join(self.directory, job.id)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, SCRATCH_OWNER_FILE), 'w') as f:
+            f.write(str(os.getpid()))
+        return path
+
+    def release(self, job):
+        """Delete the job's directory with everything in it and return its reservation."""
+        if job.work_dir:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+        with self._cond:
+            if self._reservations.pop(job.id, None) is not None:
+                self._cond.notify_all()
+
+    def sweep(self):
+        """Remove directories of dead workers and directories idle for longer than max_age."""
+        now = time.time()
+        used = 0
+        with self._cond:
+            active = set(self._reservations)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name in active or not os.path.isdir(path):
+                continue
+            try:
+                size, newest = tree_size_and_mtime(path)
+            except OSError:
+                continue # Released while we looked at it
+            owner = self._owner(path)
+            idle = now - newest
+            if owner is None or owner == os.getpid():
+                # Unreserved but ours, or not claimed yet: a leftover unless it was just created
+                stale = idle > JANITOR_INTERVAL
+            else:
+                stale = not pid_alive(owner) or idle > self.max_age
+            if stale:
+                self._remove(path)
+            else:
+                used += size
+        for name in active:
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                used += tree_size_and_mtime(path)[0]
+        self.used_bytes = used
+
+    def run_janitor(self, stop):
+        while not stop.wait(JANITOR_INTERVAL):
+            try:
+                self.sweep()
+                RESULT_CACHE.remove_stale_temp_files(self.max_age)
+                prune_jobs()
+                prune_previews()
+            except Exception as e:
+                print(f"Scratch janitor error: {e}")
+
+    def start_janitor(self):
+        stop = threading.Event()
+        threading.Thread(target=self.run_janitor, args=(stop,), name='scratch-janitor', daemon=True).start()
+        return stop
+
+    def stats(self):
+        with self._cond:
+            reserved = sum(self._reservations.values())
+            jobs = len(self._reservations)
+        return {
+            'directory': self.directory,
+            'jobs': jobs,
+            'reserved_bytes': reserved,
+            'used_bytes': self.used_bytes,
+            'quota_bytes': self.quota_bytes,
+            'free_bytes': shutil.disk_usage(self.directory).free,
+            'waits': self.waits,
+            'rejections': self.rejections,
+            'removed_dirs': self.removed_dirs
+        }
+
+SCRATCH = ScratchStorage(SCRATCH_DIR, SCRATCH_QUOTA_BYTES, SCRATCH_MIN_FREE_BYTES, SCRATCH_MAX_AGE)
+SCRATCH.start_janitor() # First sweep after JANITOR_INTERVAL, once everything below is defined
+
+# Earlier versions wrote intermediate files straight into TEMP_DIR; nothing does any more
+for leftover in os.listdir(TEMP_DIR):
+    if os.path.isfile(os.path.join(TEMP_DIR, leftover)):
+        os.remove(os.path.join(TEMP_DIR, leftover))
+
+def remove_work_dir(job):
+    """Delete the job's private directory and every intermediate file in it."""
+    SCRATCH.release(job)
+
+def estimate_scratch_bytes(info, params, trim_window, range_fetch):
+    """Bytes a job is expected to write to scratch: the downloaded streams plus the output file."""
+    duration = (info or {}).get('duration')
+    formats = {f.get('format_id'): f for f in (info or {}).get('formats') or []}
+    wanted = [params['format_id']] if not (params['is_video_only'] and params['download_format'] == 'mp3') else []
+    if params['is_video_only']:
+        wanted.append(params.get('audio_format_id'))
+    sizes = [compact_format(formats[format_id], duration).filesize for format_id in wanted if format_id in formats]
+    if not sizes or None in sizes or len(sizes) < len(wanted):
+        return SCRATCH_DEFAULT_RESERVATION
+    source_bytes = int(sum(sizes))
+    clip_bytes = source_bytes
+    if trim_window and duration:
+        clip_bytes = int(source_bytes * min(1.0, (trim_window[1] - trim_window[0]) / duration))
+    if range_fetch:
+        return clip_bytes # Only the output is written locally
+    # Streamed output goes to the result cache directory, not scratch
+    return source_bytes + (0 if params.get('stream') else clip_bytes)
+
+def prune_jobs():
+    """Forget finished jobs and batches older than JOB_RETENTION."""
+    now = time.time()
+    with JOBS_LOCK:
+        expired = [job for job in JOBS.values() if job.finished_at and now - job.finished_at > JOB_RETENTION]
+        for job in expired:
+            del JOBS[job.id]
+        for batch_id in [batch_id for batch_id, batch in BATCHES.items()
+                         if batch.finished_at and now - batch.finished_at > JOB_RETENTION]:
+            del BATCHES[batch_id]
+
+def expire_unclaimed_stream(job):
+    """Drop a ready stream nobody fetched in time, handing its flight to the jobs coalesced onto it."""
+    with JOBS_LOCK:
+        if job.status != 'ready' or JOBS.pop(job.id, None) is None:
+            return # Being streamed (or already gone)
+    job.status = 'expired'
+    record_job_outcome(job, 'aborted')
+    remove_work_dir(job)
+    finish_flight(job) # No file was published, so the next follower becomes the leader
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+# --- Content-addressed result cache ---
+# Finished clips are kept on disk keyed by everything that determines their bytes, so
+# repeated requests for the same video/format/window skip yt-dlp and ffmpeg entirely.
+# Files are published atomically (temp file + rename) and evicted LRU above a byte cap.
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(TEMP_DIR, 'cache'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+RESULT_CACHE_KEY_LENGTH = 64 # sha256 hex digest, followed by '_' and the download name
+
+def trim_window_seconds(start_time_str, end_time_str):
+    """Return (start, end) in seconds, or None when there is nothing to trim."""
+    if not start_time_str or not end_time_str:
+        return None
+    start_sec = time_to_seconds(start_time_str)
+    end_sec = time_to_seconds(end_time_str)
+    return (start_sec, end_sec) if end_sec > start_sec else None
+
+def streams_output(params):
+    """True when the job's last ffmpeg stage is left to /jobs/<id>/stream (smart cuts always write a file)."""
+    smart_cut = (params['download_format'] == 'mp4' and params.get('trim_mode', TRIM_MODE) == 'smart'
+                 and trim_window_seconds(params.get('start_time'), params.get('end_time')))
+    return bool(params.get('stream')) and not smart_cut
+
+def result_cache_key(params):
+    """Hash of every request parameter and encoder setting that affects the output bytes."""
+    encoding = job_encoding(params)
+    key_fields = {
+        'video': normalize_video_id(params['url']),
+        'format_id': params['format_id'],
+        'audio_format_id': params.get('audio_format_id'),
+        'download_format': params['download_format'],
+        'window': trim_window_seconds(params.get('start_time'), params.get('end_time')),
+        # A stream is written without seeking back (fragmented MP4 instead of +faststart)
+        'delivery': 'stream' if streams_output(params) else 'file',
+        'encoder': {
+            'trim_mode': params.get('trim_mode'),
+            'x264_preset': encoding.preset,
+            'x264_crf': encoding.crf,
+            'audio_bitrate': encoding.audio_bitrate
+        }
+    }
+    return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    """Size-bounded LRU cache of finished files with atomic publish."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (path, size), least recently used first
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Index files left by a previous run (oldest access first) and drop unfinished temp files."""
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if '.tmp-' in name:
+                owner = temp_owner(name)
+                if owner is None or owner == os.getpid() or not pid_alive(owner):
+                    os.remove(path) # Left by a dead worker; live siblings keep theirs
+                continue
+            if len(name) > RESULT_CACHE_KEY_LENGTH and name[RESULT_CACHE_KEY_LENGTH] == '_':
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name[:RESULT_CACHE_KEY_LENGTH], path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self.total_bytes += size
+        self._evict()
+
+    def lookup(self, key):
+        """Return the cached file path for key (marking it recently used), or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(entry[0]):
+                del self._entries[key] # Removed behind our back
+                self.total_bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[1]
+        try:
+            os.utime(entry[0]) # Keep the LRU order across restarts
+        except OSError:
+            pass
+        return entry[0]
+
+    def temp_path(self, key):
+        """A private path inside the cache directory to write a result before publishing it."""
+        return os.path.join(self.directory, f"{key}.tmp-{os.getpid()}-{uuid.uuid4().hex}")
+
+    def remove_stale_temp_files(self, max_age):
+        """Remove temp files of dead workers and any older than max_age seconds."""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if '.tmp-' not in name:
+                continue
+            path = os.path.join(self.directory, name)
+            owner = temp_owner(name)
+            try:
+                if owner is None or not pid_alive(owner) or now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass # Published or removed in the meantime
+
+    def publish(self, key, source_path, download_name):
+        """Atomically move a finished file into the cache and return its cached path."""
+        path = os.path.join(self.directory, f"{key}_{download_name}")
+        try:
+            os.replace(source_path, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Scratch is on another filesystem (a tmpfs): copy next to the cache, then rename
+            temp_path = self.temp_path(key)
+            try:
+                shutil.copyfile(source_path, temp_path)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            os.remove(source_path)
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+                if previous[0] != path and os.path.exists(previous[0]):
+                    os.remove(previous[0])
+            self._entries[key] = (path, size)
+            self.total_bytes += size
+            self._evict(keep=key)
+        return path
+
+    def _evict(self, keep=None):
+        """Remove least recently used files until the cache fits in max_bytes. Caller holds the lock."""
+        for key in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            path, size = self._entries.pop(key)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path) # Open readers keep their handle on POSIX
+            except OSError as e:
+                print(f"Error evicting cached file {path}: {e}")
+
+    @staticmethod
+    def download_name(path):
+        return os.path.basename(path)[RESULT_CACHE_KEY_LENGTH + 1:]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'evictions': self.evictions
+            }
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# Identical /download requests (same result cache key) coalesce onto one leader job;
+# the followers take no worker thread and get the leader's file when it is cached.
+DOWNLOAD_FLIGHTS = {} # cache key -> leader DownloadJob
+DOWNLOAD_FLIGHT_STATS = {'leaders': 0, 'followers': 0}
+
+def finish_flight(leader):
+    """Hand the leader's outcome to the jobs coalesced onto it and close its flight."""
+    with JOBS_LOCK:
+        if DOWNLOAD_FLIGHTS.get(leader.cache_key) is leader:
+            del DOWNLOAD_FLIGHTS[leader.cache_key]
+        followers, leader.followers = leader.followers, []
+    if not followers:
+        return
+    for follower in followers:
+        cached_path = RESULT_CACHE.lookup(leader.cache_key)
+        if cached_path is None:
+            break
+        follower.file_path = cached_path
+        follower.download_name = ResultCache.download_name(cached_path)
+        follower.status = follower.stage = 'finished'
+        follower.progress = 1.0
+        follower.leader = None
+        follower.finished_at = time.time()
+        record_job_outcome(follower, 'coalesced')
+    else:
+        return
+    waiting = [follower for follower in followers if follower.leader is not None]
+    if not waiting:
+        return
+    if leader.status == 'failed':
+        for follower in waiting:
+            follower.error = leader.error
+            follower.status = 'failed'
+            follower.leader = None
+            follower.finished_at = time.time()
+            record_job_outcome(follower, 'failed')
+        return
+    # The leader ended without a cached file (e.g. an aborted stream): promote the next job
+    new_leader = waiting[0]
+    new_leader.leader = None
+    with JOBS_LOCK:
+        DOWNLOAD_FLIGHTS[new_leader.cache_key] = new_leader
+        new_leader.followers = waiting[1:]
+        for follower in new_leader.followers:
+            follower.leader = new_leader
+    JOB_EXECUTOR.submit(run_download_job, new_leader)
 
 # Route to download video (with cutting and audio merging options)
+# Queues the work and returns a job ID right away; poll /jobs/<id> for progress.
 @app.route('/download', methods=['POST'])
 def download_video():
     data = request.json
     url = data.get('url')
     format_id = data.get('format_id')
     download_format = data.get('download_format') # 'mp4' or 'mp3'
-    is_video_only = data.get('is_video_only', False) # Indicates if the selected format is video-only
-    start_time_str = data.get('start_time') # HH:MM:SS
-    end_time_str = data.get('end_time') # HH:MM:SS
 
     if not url or not format_id or not download_format:
         return jsonify({"error": "Missing URL, format_id, or download_format"}), 400
+    if download_format not in ('mp4', 'mp3'):
+        # It names the output file and picks the container and codecs ffmpeg is asked for
+        return jsonify({"error": "download_format must be mp4 or mp3"}), 400
+
+    trim_mode = data.get('trim_mode') or TRIM_MODE
+    if trim_mode not in TRIM_MODES:
+        return jsonify({"error": f"trim_mode must be one of: {', '.join(TRIM_MODES)}"}), 400
+
+    encoding_profile = data.get('encoding_profile') or ENCODING_PROFILE
+    if encoding_profile not in ENCODING_PROFILES and encoding_profile != 'adaptive':
+        return jsonify({"error": f"encoding_profile must be one of: {', '.join(ENCODING_PROFILES)}, adaptive"}), 400
+
+    try:
+        trim_window = trim_window_seconds(data.get('start_time'), data.get('end_time'))
+    except ValueError:
+        return jsonify({"error": "start_time and end_time must be HH:MM:SS"}), 400
+    if SCRATCH.is_full():
+        return jsonify({"error": "The server is out of temporary storage, please try again later."}), 503, {'Retry-After': '60'}
+
+    prune_jobs()
+    # Resolve 'adaptive' now, so the cache key reflects the settings the clip is encoded with
+    info = INFO_CACHE.peek(normalize_video_id(url)) # The job's own lookup is the one that counts
+    encoding_profile, encoder_threads = choose_encoding(
+        encoding_profile, trim_window[1] - trim_window[0] if trim_window else (info or {}).get('duration'),
+        format_height(info, format_id)
+    )
+    job = DownloadJob({
+        'url': url,
+        'format_id': format_id,
+        'download_format': download_format,
+        'is_video_only': data.get('is_video_only', False), # Indicates if the selected format is video-only
+        'audio_format_id': data.get('audio_format_id'), # Audio paired with a video-only format by rank_formats
+        'start_time': data.get('start_time'), # HH:MM:SS
+        'end_time': data.get('end_time'), # HH:MM:SS
+        'range_fetch': data.get('range_fetch', RANGE_FETCH), # Fetch only the trim window from the remote stream
+        'trim_mode': trim_mode, # precise, smart or keyframe
+        'encoding_profile': encoding_profile, # latency, balanced or quality
+        'encoder_threads': encoder_threads, # -threads cap set by the adaptive profile, None for ffmpeg's default
+        'stream': bool(data.get('stream', False)) # Stream the last ffmpeg stage instead of writing a file
+    })
+    job.cache_key = result_cache_key(job.params)
+    with JOBS_LOCK:
+        JOBS[job.id] = job
+        leader = DOWNLOAD_FLIGHTS.get(job.cache_key)
+        if leader is None:
+            DOWNLOAD_FLIGHTS[job.cache_key] = job
+            DOWNLOAD_FLIGHT_STATS['leaders'] += 1
+        else:
+            job.leader = leader
+            leader.followers.append(job)
+            DOWNLOAD_FLIGHT_STATS['followers'] += 1
+    if leader is None:
+        JOB_EXECUTOR.submit(run_download_job, job)
+    return jsonify({"job_id": job.id, "status": job.status}), 202
+
+# Route to poll the status and progress of a download job
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict()), 200
+
+# Route to fetch the result of a finished download job
+@app.route('/jobs/<job_id>/file')
+def job_file(job_id):
+    job, error = finished_job(job_id)
+    if error:
+        return jsonify(error[0]), error[1]
+
+    # The file lives in the result cache and is evicted from there, not deleted after sending
+    response = send_file(job.file_path, as_attachment=True, download_name=job.download_name or os.path.basename(job.file_path))
+    if response.status_code in (200, 206):
+        record_send_on_close(response, job)
+    return response
+
+def record_send_on_close(response, job):
+    """Record the send stage when the server closes the body of a send_file response.
 
-    temp_dir = 'temp_downloads'
-    os.makedirs(temp_dir, exist_ok=True)
+    The body stays passed straight through, so gunicorn can sendfile() it, and call_on_close
+    never runs for it. The server closes the body after the last byte or, with the error
+    still in flight, when the client goes away.
+    """
+    body = response.response
+    close = body.close
+    started = time.perf_counter()
+
+    def timed_close():
+        aborted = sys.exc_info()[0] is not None
+        if aborted:
+            # Bytes read or sent so far; unknown for a range, which werkzeug wraps
+            f = getattr(body, 'filelike', getattr(body, 'file', None))
+            bytes_out = f.tell() if f is not None and not f.closed else None
+        else:
+            bytes_out = response.content_length
+        close()
+        record_stage('send', time.perf_counter() - started, 'aborted' if aborted else 'ok', job,
+                     {'delivery': 'file', 'operations': job.operations}, {'bytes_out': bytes_out})
+
+    body.close = timed_close
+
+def finished_job(job_id):
+    """Look up a job whose file can be fetched: (job, None), or (None, (error body, status))."""
+    job = get_job(job_id)
+    if job is None:
+        return None, ({"error": "Unknown job"}, 404)
+    if job.status != 'finished':
+        return None, ({"error": f"Job is {job.status}", "status": job.status}, 409)
+    if not job.file_path or not os.path.exists(job.file_path):
+        return None, ({"error": "The file for this job is no longer available"}, 410)
+    return job, None
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_POLL_INTERVAL = 0.05 # Seconds between looks at the output of a stream still being written
+STREAM_MIMETYPES = {'mp4': 'video/mp4', 'mp3': 'audio/mpeg'}
+
+class StreamProducer:
+    """Runs the last ffmpeg stage of a streamed job into a result cache temp file.
+
+    ffmpeg writes the file as fast as it can under an FFMPEG_SLOTS slot and gives the
+    slot back when it exits, however slowly the client reads; the response follows
+    the file as it grows (read). Piped to the client, ffmpeg would be paced by the
+    client and hold its slot for the whole download.
+    """
+
+    def __init__(self, job, path):
+        self.job = job
+        self.path = path
+        self.outcome = None # 'streamed' or 'failed' once ffmpeg has exited, None if cancelled
+        self.cpu_seconds = None
+        self.done = threading.Event()
+        self._cancelled = False
+        self._process = None
+        self._lock = threading.Lock()
+        self._output = open(path, 'wb') # Exists before the response opens it
+        threading.Thread(target=self._run, name=f"stream-{job.id[:8]}", daemon=True).start()
+
+    def _run(self):
+        try:
+            with self._output, tempfile.TemporaryFile() as stderr_file:
+                # Poll for the slot, so a client that leaves while waiting is not stuck behind it
+                while not FFMPEG_SLOTS.acquire(timeout=STREAM_POLL_INTERVAL * 10):
+                    if self._cancelled:
+                        return
+                try:
+                    with self._lock:
+                        if self._cancelled:
+                            return
+                        self._process = subprocess.Popen(self.job.stream_command, stdout=self._output, stderr=stderr_file)
+                    returncode, self.cpu_seconds = wait_with_rusage(self._process)
+                finally:
+                    FFMPEG_SLOTS.release()
+                if self._cancelled:
+                    return
+                if returncode != 0:
+                    stderr_file.seek(0)
+                    print(f"FFmpeg streaming error stderr: {stderr_file.read().decode(errors='replace')}")
+                    self.outcome = 'failed'
+                else:
+                    self.outcome = 'streamed'
+        except Exception as e:
+            print(f"Error producing stream for job {self.job.id}: {e}")
+            self.outcome = 'failed'
+        finally:
+            self.done.set()
+
+    def read(self, f):
+        """Next chunk of the output from f, b'' at its end, or None while ffmpeg has not written more yet."""
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        if chunk or not self.done.is_set():
+            return chunk or None
+        return f.read(STREAM_CHUNK_SIZE) # Whatever ffmpeg wrote between the two looks
+
+    def cancel(self):
+        """Stop ffmpeg, or the wait for a slot, and return once the producer has ended."""
+        with self._lock:
+            self._cancelled = True
+            if self._process is not None and self._process.returncode is None:
+                self._process.kill()
+        self.done.wait()
+
+    def finish(self):
+        """Stop the producer and publish its output if ffmpeg completed it, even for a client that left."""
+        self.cancel()
+        if self.outcome == 'streamed':
+            RESULT_CACHE.publish(self.job.cache_key, self.path, self.job.download_name)
+
+# Route to stream the result of a job whose last ffmpeg stage was left for the client
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    job, error = claim_stream_job(job_id)
+    if error:
+        return jsonify(error[0]), error[1]
+
+    def generate():
+        # The output goes to the result cache, so the next identical request is a cache hit
+        cache_temp_path = RESULT_CACHE.temp_path(job.cache_key)
+        producer = StreamProducer(job, cache_temp_path)
+        outcome = 'aborted'
+        try:
+            with open(cache_temp_path, 'rb') as f, \
+                    timed_stage('send', job, delivery='stream', operations=job.operations) as timing:
+                timing['bytes_out'] = 0
+                while True:
+                    chunk = producer.read(f)
+                    if chunk is None:
+                        producer.done.wait(STREAM_POLL_INTERVAL)
+                        continue
+                    if not chunk:
+                        break
+                    timing['bytes_out'] += len(chunk)
+                    yield chunk
+                timing['cpu_seconds'] = producer.cpu_seconds
+                outcome = producer.outcome
+        finally:
+            # Client went away or ffmpeg failed: stop ffmpeg before dropping the inputs
+            try:
+                producer.finish()
+            finally:
+                end_stream(job, outcome, cache_temp_path)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=STREAM_MIMETYPES.get(job.params['download_format'], 'application/octet-stream'),
+        headers={'Content-Disposition': attachment_disposition(job.download_name)}
+    )
+
+def claim_stream_job(job_id):
+    """Take a job that is ready to stream out of JOBS, so only one client streams it.
+
+    Returns (job, None), or (None, (error body, status)) when it cannot be streamed.
+    """
+    job = get_job(job_id)
+    if job is None:
+        return None, ({"error": "Unknown job"}, 404)
+    if job.status != 'ready' or not job.stream_command:
+        return None, ({"error": f"Job is {job.status}", "status": job.status}, 409)
+    with JOBS_LOCK:
+        # One stream per job, the inputs are deleted once it ends
+        if JOBS.pop(job.id, None) is None:
+            return None, ({"error": "This job is already being streamed"}, 409)
+    job.status = 'streaming'
+    return job, None
+
+def end_stream(job, outcome, cache_temp_path):
+    """Clean up after a streamed job: record it, drop the unpublished tee and the inputs."""
+    print(f"Finished streaming {job.download_name}")
+    record_job_outcome(job, outcome)
+    if os.path.exists(cache_temp_path):
+        os.remove(cache_temp_path)
+    remove_work_dir(job)
+    finish_flight(job)
+
+def attachment_disposition(download_name):
+    """Content-Disposition for a download, with an ASCII fallback name for old clients."""
+    ascii_name = download_name.encode('ascii', 'ignore').decode() or f"download{os.path.splitext(download_name)[1]}"
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
+
+def record_job_outcome(job, outcome):
+    """Count a job that has ended (finished, cached, coalesced, streamed, aborted or failed) and log it."""
+    seconds = time.time() - job.created_at
+    download_format = job.params.get('download_format')
+    # Labels only take values from a fixed set: every distinct value is a series kept for good
+    format_label = download_format if download_format in ('mp4', 'mp3') else 'other'
+    METRICS.inc('cutter_jobs_total', download_format=format_label, outcome=outcome)
+    METRICS.observe('cutter_job_duration_seconds', seconds, download_format=format_label, outcome=outcome)
+    log_event('job', job_id=job.id, outcome=outcome, seconds=round(seconds, 3), download_format=download_format,
+              format_id=job.params.get('format_id'), trim_mode=job.params.get('trim_mode'), operations=job.operations,
+              encoding_profile=job.params.get('encoding_profile'), encoder_threads=job.params.get('encoder_threads'))
+
+def run_download_job(job):
+    """Worker entry point: serve from the result cache or run the pipeline, and record the outcome."""
+    job.status = 'running'
+    cache_hit = False
+    try:
+        cached_path = RESULT_CACHE.lookup(job.cache_key)
+        if cached_path:
+            print(f"Result cache hit for job {job.id}")
+            cache_hit = True
+            job.file_path = cached_path
+            job.download_name = ResultCache.download_name(cached_path)
+        else:
+            output_path = process_download(job)
+            if output_path:
+                job.file_path = RESULT_CACHE.publish(job.cache_key, output_path, job.download_name)
+        job.status = 'ready' if job.stream_command else 'finished'
+        job.stage = job.status
+        job.progress = 1.0
+    except Exception as e:
+        print(f"Download/processing error: {e}")
+        job.error = str(e)
+        job.status = 'failed'
+    finally:
+        job.finished_at = time.time()
+        if job.status != 'ready': # Streams are counted once /jobs/<id>/stream ends
+            record_job_outcome(job, 'cached' if cache_hit else job.status)
+        # A pending stream keeps its inputs and followers until it has been written to the cache,
+        # or until STREAM_CLAIM_TIMEOUT if its client never comes (e.g. the tab was closed)
+        if job.stream_command and job.status == 'ready':
+            timer = threading.Timer(STREAM_CLAIM_TIMEOUT, expire_unclaimed_stream, (job,))
+            timer.daemon = True
+            timer.start()
+        else:
+            remove_work_dir(job)
+            finish_flight(job)
+
+def pipeline_operations(download_format, is_video_only, trim_window):
+    """Name the work the ffmpeg stage does (merge, extract, trim, convert) for metric labels."""
+    operations = []
+    if download_format == 'mp3':
+        operations += ['extract', 'convert']
+    elif is_video_only:
+        operations.append('merge')
+    if trim_window:
+        operations.append('trim')
+    return '+'.join(operations) or 'remux'
+
+def sanitize_title(video_title):
+    """Turn a video title into a safe file name stem."""
+    # Remove characters that are problematic in filenames
+    # Also, replace spaces with underscores to avoid issues in shell commands
+    sanitized_title = re.sub(r'[^\w\s.-]', '', video_title).strip().replace(' ', '_')
+    # Limit length to avoid excessively long filenames
+    sanitized_title = sanitized_title[:80] if len(sanitized_title) > 80 else sanitized_title
+    return sanitized_title.rstrip('._-') or 'video' # Remove trailing special chars
+
+def download_sources(job, url, info, format_id, audio_spec, needs_video, needs_audio, output_filename_base):
+    """Step 1: download the video and, for video-only formats, the audio stream concurrently.
+
+    Returns the local (path, headers) sources for plan_ffmpeg_pipeline.
+    """
+    temp_video_path = None
+    temp_audio_path = None
+    audio_future = None
+    if needs_audio:
+        print("Detected video-only format, downloading audio alongside the video...")
+        audio_future = STREAM_DOWNLOAD_EXECUTOR.submit(
+            download_stream, job, url, info, audio_spec, f"{output_filename_base}_audio.%(ext)s", 'download_audio'
+        )
+    try:
+        if needs_video:
+            temp_video_path = download_stream(
+                job, url, info, format_id, f"{output_filename_base}_video.%(ext)s", 'download_video'
+            )
+            print(f"Downloaded raw video file: {temp_video_path}")
+    finally:
+        if audio_future is not None:
+            # Never leave the audio download writing into a work dir that may be removed by the caller
+            wait([audio_future])
+    if audio_future is not None:
+        # The audio is kept as downloaded; the merge encodes it to AAC/MP3 (or copies AAC)
+        temp_audio_path = audio_future.result()
+        print(f"Downloaded audio file: {temp_audio_path}")
+
+    local_paths = [path for path in (temp_video_path, temp_audio_path) if path]
+    if not local_paths or not all(os.path.exists(path) for path in local_paths):
+        raise Exception("Required video or audio file was not found.")
+    return [(path, None) for path in local_paths]
+
+def transcode_clip(job, command, sources, trim_window, clip_duration, output_path, stage):
+    """Step 2: run the planned ffmpeg command (or a smart cut) into output_path."""
+    download_format = job.params['download_format']
+    trim_mode = job.params.get('trim_mode', TRIM_MODE)
+    encoding = job_encoding(job.params)
+    print(f"Processing into {output_path}...")
+    try:
+        with timed_stage(stage, job, operations=job.operations) as timing:
+            if not (download_format == 'mp4' and trim_window and trim_mode == 'smart'
+                    and smart_cut(job, sources, trim_window, output_path, stage, encoding)):
+                run_ffmpeg(command, job, stage, clip_duration)
+            timing['bytes_out'] = os.path.getsize(output_path)
+            timing['cpu_seconds'] = round(job.ffmpeg_cpu_seconds, 3)
+        print("Processing successful.")
+    except subprocess.CalledProcessError as e:
+        print(f"FFmpeg processing error stderr: {e.stderr.decode()}")
+        raise Exception(f"Failed to process {'video' if download_format == 'mp4' else 'audio'}: {e.stderr.decode().strip()}")
+
+def process_download(job):
+    """Download the sources and run the planned ffmpeg command for job.params. Returns the final file path."""
+    url = job.params['url']
+    format_id = job.params['format_id']
+    download_format = job.params['download_format']
+    is_video_only = job.params['is_video_only']
+    start_time_str = job.params['start_time']
+    end_time_str = job.params['end_time']
+    trim_mode = job.params.get('trim_mode', TRIM_MODE)
+    audio_format_id = job.params.get('audio_format_id')
+    audio_spec = audio_format_id or AUDIO_FORMAT_SPEC
 
     # Sanitize title for filename
+    info = None
     try:
-        with yt_dlp.YoutubeDL({'quiet': True, 'skip_download': True, 'dump_single_json': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            video_title = info.get('title', 'video')
-            # Remove characters that are problematic in filenames
-            # Also, replace spaces with underscores to avoid issues in shell commands
-            sanitized_title = re.sub(r'[^\w\s.-]', '', video_title).strip().replace(' ', '_')
-            # Limit length to avoid excessively long filenames
-            sanitized_title = sanitized_title[:80] if len(sanitized_title) > 80 else sanitized_title
-            sanitized_title = sanitized_title.rstrip('._-') # Remove trailing special chars
+        info = get_cached_info(url)
+        sanitized_title = sanitize_title(info.get('title', 'video'))
     except Exception as e:
         print(f"Error getting video title: {e}")
         sanitized_title = f"download_{int(time.time())}" # Fallback to a unique filename
 
-    output_filename_base = os.path.join(temp_dir, sanitized_title)
+    source_duration = info.get('duration') if info else None
+
+    # Work out the trim window up front so progress can be planned per stage
+    trim_window = trim_window_seconds(start_time_str, end_time_str)
+    if start_time_str and end_time_str and not trim_window:
+        print("End time is before or same as start time, skipping trimming.")
+    clip_duration = trim_window[1] - trim_window[0] if trim_window else source_duration
+
+    # A range fetch reads the trim window straight from the remote stream(s) instead of downloading
+    range_sources = None
+    if trim_window and job.params.get('range_fetch'):
+        range_sources = range_fetch_sources(info, format_id, download_format, is_video_only, audio_spec)
+        if range_sources is None:
+            print("Range fetch is not possible for this format, downloading the full stream.")
+
+    # Every job works in its own scratch directory, so concurrent jobs for one video never
+    # collide; this waits while the scratch quota is used up by other jobs
+    job.work_dir = SCRATCH.allocate(job, estimate_scratch_bytes(info, job.params, trim_window, bool(range_sources)))
+    output_filename_base = os.path.join(job.work_dir, sanitized_title)
+    job.output_filename_base = output_filename_base
+    job.download_name = f"{sanitized_title}.{download_format}"
     final_output_path = f"{output_filename_base}.{download_format}"
-    
-    # Clean up previous temp files for this video
-    for f in os.listdir(temp_dir):
-        if f.startswith(sanitized_title) and (f.endswith('.mp4') or f.endswith('.mp3') or f.endswith('.mkv') or f.endswith('.webm') or f.endswith('.m4a') or f.endswith('.opus') or f.endswith('.aac')):
-            try:
-                os.remove(os.path.join(temp_dir, f))
-            except OSError as cleanup_error:
-                print(f"Error cleaning up old temp file {f}: {cleanup_error}")
 
-    temp_video_path = None
-    temp_audio_path = None
-    audio_extracted_path = None # New variable for extracted audio path
+    # An MP3 from a video-only format only needs the audio stream
+    needs_video_download = not range_sources and not (is_video_only and download_format == 'mp3')
+    needs_audio_download = not range_sources and is_video_only
+    stages = []
+    if needs_video_download and needs_audio_download:
+        stages.append(('download_video', 'download_audio')) # Both streams download at the same time
+    elif needs_video_download:
+        stages.append('download_video')
+    elif needs_audio_download:
+        stages.append('download_audio')
+    stages.append('fetch_range' if range_sources else 'transcode')
+    job.plan_stages(stages)
+    job.operations = pipeline_operations(download_format, is_video_only, trim_window)
 
     try:
-        # Step 1: Download video stream (and potentially audio if combined)
-        ydl_opts_video = {
-            'format': format_id,
-            'outtmpl': f"{output_filename_base}_video.%(ext)s",
-            'noplaylist': True,
-            'quiet': True,
-            'no_warnings': True,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts_video) as ydl_video:
-            info_video = ydl_video.extract_info(url, download=True)
-            temp_video_path = ydl_video.prepare_filename(info_video)
-            
-        print(f"Downloaded raw video file: {temp_video_path}")
-
-        # If it's a video-only format, we need to download the best audio separately
-        if is_video_only:
-            print("Detected video-only format, downloading best audio...")
-            audio_ydl_opts = {
-                'format': 'bestaudio[ext=m4a]/bestaudio[ext=opus]/bestaudio', # Prefer m4a or opus
-                'outtmpl': f"{output_filename_base}_audio.%(ext)s",
-                'noplaylist': True,
-                'quiet': True,
-                'no_warnings': True,
-                'extractaudio': True,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'm4a', # Ensure consistency for merging
-                }],
-            }
-            with yt_dlp.YoutubeDL(audio_ydl_opts) as ydl_audio:
-                audio_info = ydl_audio.extract_info(url, download=True)
-                # yt-dlp might change extension based on postprocessor
-                downloaded_audio_path_base = ydl_audio.prepare_filename(audio_info)
-                temp_audio_path = os.path.join(temp_dir, os.path.basename(downloaded_audio_path_base))
-                
-                # Check for actual extension change by postprocessor (e.g., webm to m4a)
-                if audio_info.get('ext') == 'webm' and audio_ydl_opts['postprocessors'][0]['preferredcodec'] == 'm4a':
-                     temp_audio_path = temp_audio_path.replace('.webm', '.m4a')
-                
-            print(f"Downloaded audio file: {temp_audio_path}")
-
-        # Step 2: Merge video and audio if necessary (for is_video_only cases)
-        current_processed_path = temp_video_path # Track the path of the most recent file
-        
-        if is_video_only and temp_video_path and temp_audio_path and os.path.exists(temp_video_path) and os.path.exists(temp_audio_path):
-            merged_video_path = f"{output_filename_base}_merged.mp4"
-            print(f"Merging video ({temp_video_path}) and audio ({temp_audio_path}) into {merged_video_path}...")
-            
-            merge_command = [
-                'ffmpeg',
-                '-i', temp_video_path,
-                '-i', temp_audio_path,
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-b:a', '192k',
-                '-map', '0:v:0',
-                '-map', '1:a:0',
-                '-shortest',
-                '-strict', 'experimental',
-                '-y',
-                merged_video_path
-            ]
-            
-            try:
-                subprocess.run(merge_command, check=True, capture_output=True)
-                print("Merge successful.")
-                os.remove(temp_video_path)
-                os.remove(temp_audio_path)
-                current_processed_path = merged_video_path
-            except subprocess.CalledProcessError as e:
-                print(f"FFmpeg merge error stdout: {e.stdout.decode()}")
-                print(f"FFmpeg merge error stderr: {e.stderr.decode()}")
-                raise Exception(f"Failed to merge video and audio: {e.stderr.decode().strip()}")
-        elif is_video_only:
-            raise Exception("Required video or audio file for merging was not found.")
-
-        # --- New Logic for MP3 download path ---
-        if download_format == 'mp3':
-            print("Preparing for MP3 download: extracting audio...")
-            audio_extracted_path = f"{output_filename_base}_extracted_audio.m4a" # Use m4a as a robust intermediate format
-            
-            extract_audio_command = [
-                'ffmpeg',
-                '-i', current_processed_path, # Input is the current video file (either original or merged)
-                '-vn', # No video
-                '-c:a', 'aac', # Re-encode to AAC for consistency before MP3 conversion
-                '-b:a', '192k',
-                '-map', '0:a:0', # Map only the audio stream
-                '-y',
-                audio_extracted_path
-            ]
-            try:
-                subprocess.run(extract_audio_command, check=True, capture_output=True)
-                print(f"Audio extraction successful: {audio_extracted_path}")
-                # Now, current_processed_path points to the extracted audio file for trimming
-                current_processed_path = audio_extracted_path
-            except subprocess.CalledProcessError as e:
-                print(f"FFmpeg audio extraction error stdout: {e.stdout.decode()}")
-                print(f"FFmpeg audio extraction error stderr: {e.stderr.decode()}")
-                raise Exception(f"Failed to extract audio: {e.stderr.decode().strip()}")
-
-        # Step 3: Trim the video/audio if start/end times are provided (IMPROVED VERSION)
-        if start_time_str and end_time_str:
-            def time_to_seconds(time_str):
-                parts = list(map(int, time_str.split(':')))
-                if len(parts) == 3: return parts[0] * 3600 + parts[1] * 60 + parts[2]
-                if len(parts) == 2: return parts[0] * 60 + parts[1]
-                return 0
-
-            start_sec = time_to_seconds(start_time_str)
-            end_sec = time_to_seconds(end_time_str)
-
-            if end_sec <= start_sec:
-                print("End time is before or same as start time, skipping trimming.")
-            else:
-                # تحديد امتداد الملف الحالي
-                current_ext = os.path.splitext(current_processed_path)[1]
-                trimmed_output_path = f"{output_filename_base}_trimmed{current_ext}"
-                print(f"Trimming from {start_time_str} to {end_time_str}...")
-                
-                # حساب المدة بدلاً من استخدام -to
-                duration = end_sec - start_sec
-                
-                if download_format == 'mp3':
-                    # للصوت: إعادة ترميز لضمان الجودة والدقة
-                    trim_command = [
-                        'ffmpeg',
-                        '-ss', start_time_str,  # وضع -ss قبل -i لتسريع العملية
-                        '-i', current_processed_path,
-                        '-t', str(duration),    # استخدام -t بدلاً من -to لتجنب مشاكل التوقيت
-                        '-c:a', 'aac',          # إعادة ترميز الصوت
-                        '-b:a', '192k',
-                        '-avoid_negative_ts', 'make_zero',  # تجنب مشاكل الـ timestamps
-                        '-y',
-                        trimmed_output_path
-                    ]
-                else:
-                    # للفيديو: حل هجين لتوازن السرعة والجودة
-                    trim_command = [
-                        'ffmpeg',
-                        '-ss', start_time_str,  # البحث السريع قبل فتح الملف
-                        '-i', current_processed_path,
-                        '-t', str(duration),
-                        '-c:v', 'libx264',      # إعادة ترميز الفيديو لحل مشاكل الـ keyframes
-                        '-c:a', 'aac',          # إعادة ترميز الصوت
-                        '-preset', 'fast',      # استخدام preset سريع
-                        '-crf', '23',           # جودة جيدة مع حجم معقول
-                        '-b:a', '192k',
-                        '-avoid_negative_ts', 'make_zero',
-                        '-movflags', '+faststart',  # تحسين للتشغيل السريع
-                        '-y',
-                        trimmed_output_path
-                    ]
-                
-                try:
-                    subprocess.run(trim_command, check=True, capture_output=True)
-                    print("Trimming successful.")
-                    os.remove(current_processed_path)
-                    current_processed_path = trimmed_output_path
-                except subprocess.CalledProcessError as e:
-                    print(f"FFmpeg trim error stdout: {e.stdout.decode()}")
-                    print(f"FFmpeg trim error stderr: {e.stderr.decode()}")
-                    raise Exception(f"Failed to trim {'video' if download_format == 'mp4' else 'audio'}: {e.stderr.decode().strip()}")
-
-        # Step 4: Convert to final desired format (MP3 if requested, else keep MP4)
-        if download_format == 'mp3' and current_processed_path:
-            print("Converting to MP3...")
-            mp3_output_path = f"{output_filename_base}.mp3"
-            convert_command = [
-                'ffmpeg',
-                '-i', current_processed_path, # Input is now guaranteed to be an audio-only file
-                '-vn', # No video (redundant but harmless here)
-                '-b:a', '192k',
-                '-acodec', 'libmp3lame',
-                '-y',
-                mp3_output_path
-            ]
-            try:
-                subprocess.run(convert_command, check=True, capture_output=True)
-                print("MP3 conversion successful.")
-                os.remove(current_processed_path) # Clean up audio file
-                final_output_path = mp3_output_path
-            except subprocess.CalledProcessError as e:
-                print(f"FFmpeg MP3 conversion error stdout: {e.stdout.decode()}")
-                print(f"FFmpeg MP3 conversion error stderr: {e.stderr.decode()}")
-                raise Exception(f"Failed to convert to MP3: {e.stderr.decode().strip()}")
+        if range_sources:
+            sources = range_sources
+        else:
+            sources = download_sources(
+                job, url, info, format_id, audio_spec, needs_video_download, needs_audio_download, output_filename_base
+            )
+
+        # Step 2: Merge, extract, trim and convert in a single ffmpeg run
+        stage = 'fetch_range' if range_sources else 'transcode'
+        transcode_command = plan_ffmpeg_pipeline(
+            sources, download_format, is_video_only,
+            start_time_str if trim_window else None, clip_duration if trim_window else None,
+            final_output_path, trim_mode, copy_audio=audio_is_mp4_copyable(info, audio_format_id),
+            encoding=job_encoding(job.params)
+        )
+        if transcode_command is None:
+            # Combined format with nothing to cut or convert: serve the download as-is
+            final_output_path = sources[0][0]
+            job.download_name = f"{sanitized_title}{os.path.splitext(final_output_path)[1]}"
+        elif streams_output(job.params):
+            # Leave the last stage to /jobs/<id>/stream, which pipes ffmpeg's stdout to the client
+            job.stream_command = plan_ffmpeg_pipeline(
+                sources, download_format, is_video_only,
+                start_time_str if trim_window else None, clip_duration if trim_window else None,
+                'pipe:1', trim_mode, streaming=True, copy_audio=audio_is_mp4_copyable(info, audio_format_id),
+                encoding=job_encoding(job.params)
+            )
+            print(f"Ready to stream {job.download_name}")
+            return None
         else:
-            # If not converting to MP3, the last processed video is the final
-            final_output_path = current_processed_path
+            transcode_clip(job, transcode_command, sources, trim_window, clip_duration, final_output_path, stage)
+            if not range_sources:
+                for path, _ in sources:
+                    if os.path.exists(path):
+                        os.remove(path)
 
         if not os.path.exists(final_output_path):
             raise Exception("Final output file was not created or found.")
 
-        response = send_file(final_output_path, as_attachment=True, download_name=os.path.basename(final_output_path))
-        
-        # Clean up files after sending
-        @response.call_on_close
-        def cleanup():
-            print(f"Cleaning up {final_output_path}")
-            # Ensure proper cleanup of all temp files created during the process
-            temp_files_to_check = [
-                f"{output_filename_base}_video",
-                f"{output_filename_base}_audio",
-                f"{output_filename_base}_merged",
-                f"{output_filename_base}_extracted_audio",
-                f"{output_filename_base}_trimmed",
-                f"{output_filename_base}"
-            ]
-            
-            for f_base in temp_files_to_check:
-                for ext in ['mp4', 'mkv', 'webm', 'mp3', 'm4a', 'opus', 'aac']:
-                    temp_file = f"{f_base}.{ext}"
-                    if os.path.exists(temp_file):
-                        try:
-                            os.remove(temp_file)
-                            print(f"Removed temp file: {temp_file}")
-                        except OSError as cleanup_error:
-                            print(f"Error during cleanup of {temp_file}: {cleanup_error}")
-
-        return response
+        return final_output_path
+
+    except Exception:
+        # Clean up everything this job created if an error occurs
+        remove_work_dir(job)
+        raise
+
+# --- Batch jobs: several clips from one video, or clips from every playlist entry ---
+# A batch fetches each source once (or, when its clips cover only a small part of it,
+# just their ranges) and cuts all clips from it in parallel ffmpeg processes, capped
+# by FFMPEG_SLOTS. Every clip is an ordinary DownloadJob with its own result cache
+# entry, so /jobs/<id> and /jobs/<id>/file work for it, and /batches/<id>/zip streams
+# all clips as one ZIP while they finish.
+BATCH_MAX_CLIPS = int(os.environ.get('BATCH_MAX_CLIPS', 50))
+BATCH_MAX_PLAYLIST_ITEMS = int(os.environ.get('BATCH_MAX_PLAYLIST_ITEMS', 25))
+BATCH_RANGE_FRACTION = 0.5 # Fetch only the clip ranges when they add up to less than this share of the video
+BATCH_DEFAULT_FORMATS = {'mp4': 'best[ext=mp4]/best', 'mp3': 'bestaudio/best'} # When a cut names no format
+CUT_EXECUTOR = ThreadPoolExecutor(max_workers=FFMPEG_CONCURRENCY, thread_name_prefix='batch-cut')
+BATCHES = {} # batch_id -> BatchJob, guarded by JOBS_LOCK
+
+class BatchJob:
+    """Clips cut from one video or from the entries of a playlist."""
+
+    def __init__(self, url, cuts, playlist):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.cuts = cuts
+        self.playlist = playlist
+        self.status = 'queued' # queued -> running -> finished | failed
+        self.error = None
+        self.jobs = [] # One DownloadJob per clip, added as the sources are planned
+        self.created_at = time.time()
+        self.finished_at = None
+        self._changed = threading.Condition()
+
+    def add_job(self, job):
+        with self._changed:
+            self.jobs.append(job)
+
+    def notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def ended_jobs(self):
+        """Yield the clip jobs in the order they end, until the whole batch has ended."""
+        seen = set()
+        while True:
+            with self._changed:
+                ended = [job for job in self.jobs if job.finished_at and job.id not in seen]
+                while not ended and not self.finished_at:
+                    self._changed.wait(5)
+                    ended = [job for job in self.jobs if job.finished_at and job.id not in seen]
+                if not ended:
+                    return
+            for job in ended:
+                seen.add(job.id)
+                yield job
+
+    def to_dict(self):
+        with self._changed:
+            jobs = [job.to_dict() for job in self.jobs]
+        return {
+            'batch_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'progress': round(sum(job['progress'] for job in jobs) / len(jobs), 1) if jobs else 0.0,
+            'jobs': jobs
+        }
 
+class SourceFetch:
+    """The shared download of one source; reports its progress to every clip cut from it."""
+
+    def __init__(self, batch, index, jobs):
+        self.id = f"{batch.id}-{index}" # Owns a scratch directory like a job does
+        self.jobs = jobs
+        self.stage = 'queued'
+        self.work_dir = None
+
+    def report(self, stage, fraction):
+        for job in self.jobs:
+            job.report(stage, fraction)
+
+def get_batch(batch_id):
+    with JOBS_LOCK:
+        return BATCHES.get(batch_id)
+
+def batch_source_urls(batch):
+    """The batch URL itself, or the URLs of the first playlist entries."""
+    if not batch.playlist:
+        return [batch.url]
+    max_items = min(BATCH_MAX_PLAYLIST_ITEMS, max(1, BATCH_MAX_CLIPS // len(batch.cuts)))
+    with timed_stage('extract_playlist'), YTDL_POOL.checkout(
+        skip_download=True, noplaylist=False, extract_flat='in_playlist', playlistend=max_items
+    ) as ydl:
+        playlist = ydl.extract_info(batch.url, download=False)
+    urls = [entry.get('webpage_url') or entry.get('url') for entry in playlist.get('entries') or [] if entry]
+    return [url for url in urls if url][:max_items] or [batch.url]
+
+def resolve_cut_format(info, cut):
+    """Map a cut's format (an id from /get_video_info or a yt-dlp selector) to (format_id, is_video_only, audio_format_id)."""
+    spec = cut.get('format_id') or BATCH_DEFAULT_FORMATS[cut['download_format']]
+    if any(f.get('format_id') == spec for f in info.get('formats') or []):
+        return spec, cut['is_video_only'], cut.get('audio_format_id')
+    # Playlist entries do not all offer the same formats: let yt-dlp pick per video
+    selected = resolve_streams(info, spec)
+    video = selected[0]
+    audio_format_id = selected[1]['format_id'] if len(selected) > 1 else None
+    is_video_only = audio_format_id is not None or (video.get('acodec') == 'none' and cut['download_format'] == 'mp4')
+    return video['format_id'], is_video_only, audio_format_id
+
+def plan_batch_clips(batch, url, info):
+    """Create the clip jobs for one source, grouped by the streams they need."""
+    title = sanitize_title(info.get('title', 'video'))
+    # The output format is part of the key, as it decides which streams the group downloads
+    groups = OrderedDict() # (format_id, is_video_only, audio_format_id, download_format) -> [DownloadJob]
+    for cut in batch.cuts:
+        try:
+            format_id, is_video_only, audio_format_id = resolve_cut_format(info, cut)
+        except Exception as e:
+            # This entry lacks the cut's format; its other cuts and the other entries go on
+            print(f"Batch cut format error for {url}: {e}")
+            fail_batch_clip(batch, url, cut, str(e))
+            continue
+        window = trim_window_seconds(cut.get('start_time'), cut.get('end_time'))
+        encoding_profile, encoder_threads = choose_encoding(
+            cut['encoding_profile'], window[1] - window[0] if window else info.get('duration'),
+            format_height(info, format_id)
+        )
+        job = DownloadJob({
+            'url': url,
+            'format_id': format_id,
+            'download_format': cut['download_format'],
+            'is_video_only': is_video_only,
+            'audio_format_id': audio_format_id,
+            'start_time': cut.get('start_time'),
+            'end_time': cut.get('end_time'),
+            'trim_mode': cut['trim_mode'],
+            'encoding_profile': encoding_profile,
+            'encoder_threads': encoder_threads,
+            'batch_id': batch.id
+        })
+        job.cache_key = result_cache_key(job.params)
+        suffix = f"_{job.params['start_time']}-{job.params['end_time']}".replace(':', '.') if window else ''
+        job.download_name = f"{title}{suffix}.{cut['download_format']}"
+        job.operations = pipeline_operations(cut['download_format'], is_video_only, window)
+        with JOBS_LOCK:
+            JOBS[job.id] = job
+        batch.add_job(job)
+        groups.setdefault((format_id, is_video_only, audio_format_id, cut['download_format']), []).append(job)
+    return groups
+
+def fail_batch_clip(batch, url, cut, error):
+    """Add a clip that could not be planned for this source to the batch as failed."""
+    job = DownloadJob({
+        'url': url,
+        'format_id': cut.get('format_id'),
+        'download_format': cut['download_format'],
+        'start_time': cut.get('start_time'),
+        'end_time': cut.get('end_time'),
+        'trim_mode': cut['trim_mode'],
+        'batch_id': batch.id
+    })
+    job.error = error
+    job.status = 'failed'
+    job.finished_at = time.time()
+    with JOBS_LOCK:
+        JOBS[job.id] = job
+    batch.add_job(job)
+    record_job_outcome(job, 'failed')
+
+def fetch_group_sources(fetch, url, info, jobs):
+    """Fetch what the clips of one group need: the clip ranges, or the whole streams once.
+
+    Returns (sources, stage) for the cuts.
+    """
+    params = jobs[0].params
+    format_id, is_video_only, download_format = params['format_id'], params['is_video_only'], params['download_format']
+    audio_spec = params.get('audio_format_id') or AUDIO_FORMAT_SPEC
+    windows = [trim_window_seconds(job.params['start_time'], job.params['end_time']) for job in jobs]
+    duration = info.get('duration')
+    range_sources = None
+    if RANGE_FETCH and duration and all(windows) and sum(end - start for start, end in windows) < BATCH_RANGE_FRACTION * duration:
+        range_sources = range_fetch_sources(info, format_id, download_format, is_video_only, audio_spec)
+
+    needs_video = not range_sources and not (is_video_only and download_format == 'mp3')
+    needs_audio = not range_sources and is_video_only
+    download_stages = tuple(stage for stage, needed in (('download_video', needs_video), ('download_audio', needs_audio)) if needed)
+    for job in jobs:
+        job.plan_stages(([download_stages] if download_stages else []) + ['fetch_range' if range_sources else 'transcode'])
+
+    if range_sources:
+        reservation = sum(estimate_scratch_bytes(info, job.params, window, True) for job, window in zip(jobs, windows))
+    else:
+        # The whole source once plus clips that together are usually no larger than it
+        reservation = estimate_scratch_bytes(info, params, None, False)
+    fetch.work_dir = SCRATCH.allocate(fetch, reservation)
+    if range_sources:
+        return range_sources, 'fetch_range'
+    output_filename_base = os.path.join(fetch.work_dir, 'source')
+    return download_sources(fetch, url, info, format_id, audio_spec, needs_video, needs_audio, output_filename_base), 'transcode'
+
+def run_batch_cut(batch, job, info, sources, stage, work_dir):
+    """Cut one clip from the shared sources and publish it to the result cache."""
+    job.status = 'running'
+    try:
+        params = job.params
+        trim_window = trim_window_seconds(params['start_time'], params['end_time'])
+        clip_duration = trim_window[1] - trim_window[0] if trim_window else info.get('duration')
+        job.work_dir = os.path.join(work_dir, job.id) # Smart cut segments go here
+        os.makedirs(job.work_dir, exist_ok=True)
+        output_path = os.path.join(job.work_dir, f"clip.{params['download_format']}")
+        command = plan_ffmpeg_pipeline(
+            sources, params['download_format'], params['is_video_only'],
+            params['start_time'] if trim_window else None, clip_duration if trim_window else None,
+            output_path, params['trim_mode'], copy_audio=audio_is_mp4_copyable(info, params.get('audio_format_id')),
+            encoding=job_encoding(params)
+        )
+        if command is None:
+            # Nothing to cut or convert, but the source is shared with the other clips: copy it
+            output_path = os.path.join(job.work_dir, f"clip{os.path.splitext(sources[0][0])[1]}")
+            shutil.copyfile(sources[0][0], output_path)
+            job.download_name = os.path.splitext(job.download_name)[0] + os.path.splitext(output_path)[1]
+        else:
+            transcode_clip(job, command, sources, trim_window, clip_duration, output_path, stage)
+        job.file_path = RESULT_CACHE.publish(job.cache_key, output_path, job.download_name)
+        job.status = job.stage = 'finished'
+        job.progress = 1.0
     except Exception as e:
-        print(f"Download/processing error: {e}")
-        # Attempt to clean up any created temp files if an error occurs
-        for f in os.listdir(temp_dir):
-            if f.startswith(sanitized_title):
+        print(f"Batch clip error: {e}")
+        job.error = str(e)
+        job.status = 'failed'
+    finally:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        job.work_dir = None
+        job.finished_at = time.time()
+        record_job_outcome(job, job.status)
+        batch.notify()
+
+def run_batch(batch):
+    """Worker entry point for a batch: plan the clips per source, fetch each source once and cut in parallel."""
+    batch.status = 'running'
+    fetches = [] # (SourceFetch, cut futures)
+    try:
+        for url in batch_source_urls(batch):
+            try:
+                info = get_cached_info(url)
+            except Exception as e:
+                # A private or deleted playlist entry fails its own clips, not the rest of the batch
+                print(f"Batch source error for {url}: {e}")
+                for cut in batch.cuts:
+                    fail_batch_clip(batch, url, cut, str(e))
+                batch.notify()
+                continue
+            for jobs in plan_batch_clips(batch, url, info).values():
+                pending = []
+                for job in jobs:
+                    cached_path = RESULT_CACHE.lookup(job.cache_key)
+                    if cached_path:
+                        job.file_path = cached_path
+                        job.status = job.stage = 'finished'
+                        job.progress = 1.0
+                        job.finished_at = time.time()
+                        record_job_outcome(job, 'cached')
+                    else:
+                        pending.append(job)
+                batch.notify()
+                if not pending:
+                    continue
+                fetch = SourceFetch(batch, len(fetches), pending)
+                fetches.append((fetch, []))
                 try:
-                    os.remove(os.path.join(temp_dir, f))
-                except OSError as cleanup_error:
-                    print(f"Error during error cleanup of {f}: {cleanup_error}")
-        return jsonify({"error": str(e)}), 500
+                    sources, stage = fetch_group_sources(fetch, url, info, pending)
+                except Exception as e:
+                    print(f"Batch source error: {e}")
+                    for job in pending:
+                        job.error = str(e)
+                        job.status = 'failed'
+                        job.finished_at = time.time()
+                        record_job_outcome(job, 'failed')
+                    batch.notify()
+                    continue
+                # Cutting this source overlaps with fetching the next one
+                fetches[-1][1].extend(
+                    CUT_EXECUTOR.submit(run_batch_cut, batch, job, info, sources, stage, fetch.work_dir) for job in pending
+                )
+    except Exception as e:
+        print(f"Batch error: {e}")
+        batch.error = str(e)
+    finally:
+        for fetch, futures in fetches:
+            wait(futures)
+            remove_work_dir(fetch) # The source is no longer needed once its clips are cut
+        for job in batch.jobs:
+            if not job.finished_at: # Planned, but the batch stopped before fetching its source
+                job.error = batch.error or "The batch was stopped before this clip was cut."
+                job.status = 'failed'
+                job.finished_at = time.time()
+                record_job_outcome(job, 'failed')
+        batch.status = 'finished' if any(job.status == 'finished' for job in batch.jobs) else 'failed'
+        batch.finished_at = time.time()
+        batch.notify()
+
+# Route to cut several clips from one video or from each video of a playlist
+# Body: {"url": ..., "playlist": false, "cuts": [{"start_time", "end_time", "format_id",
+# "download_format", "is_video_only", "audio_format_id", "trim_mode", "encoding_profile"}, ...]}
+@app.route('/batch', methods=['POST'])
+def create_batch():
+    data = request.json or {}
+    url = data.get('url')
+    cuts = data.get('cuts')
+    if not url or not isinstance(cuts, list) or not cuts:
+        return jsonify({"error": "url and a non-empty list of cuts are required"}), 400
+    if len(cuts) > BATCH_MAX_CLIPS:
+        return jsonify({"error": f"A batch can have at most {BATCH_MAX_CLIPS} cuts"}), 400
+
+    normalized_cuts = []
+    for cut in cuts:
+        download_format = cut.get('download_format') or data.get('download_format') or 'mp4'
+        if download_format not in BATCH_DEFAULT_FORMATS:
+            return jsonify({"error": "download_format must be mp4 or mp3"}), 400
+        trim_mode = cut.get('trim_mode') or data.get('trim_mode') or TRIM_MODE
+        if trim_mode not in TRIM_MODES:
+            return jsonify({"error": f"trim_mode must be one of: {', '.join(TRIM_MODES)}"}), 400
+        encoding_profile = cut.get('encoding_profile') or data.get('encoding_profile') or ENCODING_PROFILE
+        if encoding_profile not in ENCODING_PROFILES and encoding_profile != 'adaptive':
+            return jsonify({"error": f"encoding_profile must be one of: {', '.join(ENCODING_PROFILES)}, adaptive"}), 400
+        try:
+            trim_window_seconds(cut.get('start_time'), cut.get('end_time'))
+        except ValueError:
+            return jsonify({"error": "start_time and end_time must be HH:MM:SS"}), 400
+        normalized_cuts.append({
+            'start_time': cut.get('start_time'),
+            'end_time': cut.get('end_time'),
+            'format_id': cut.get('format_id') or data.get('format_id'),
+            'download_format': download_format,
+            'is_video_only': bool(cut.get('is_video_only', False)),
+            'audio_format_id': cut.get('audio_format_id'),
+            'trim_mode': trim_mode,
+            'encoding_profile': encoding_profile
+        })
+    if SCRATCH.is_full():
+        return jsonify({"error": "The server is out of temporary storage, please try again later."}), 503, {'Retry-After': '60'}
+
+    prune_jobs()
+    batch = BatchJob(url, normalized_cuts, bool(data.get('playlist', False)))
+    with JOBS_LOCK:
+        BATCHES[batch.id] = batch
+    JOB_EXECUTOR.submit(run_batch, batch)
+    return jsonify({"batch_id": batch.id, "status": batch.status}), 202
+
+# Route to poll a batch and the clip jobs in it
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify({"error": "Unknown batch"}), 404
+    return jsonify(batch.to_dict()), 200
+
+class ZipSink:
+    """Write-only file object for zipfile that hands out the bytes written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+# Route to stream every clip of a batch as one ZIP, each clip as soon as it is ready
+@app.route('/batches/<batch_id>/zip')
+def batch_zip(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify({"error": "Unknown batch"}), 404
+
+    def generate():
+        sink = ZipSink()
+        failures = []
+        # Stored, not deflated: the clips are already compressed media
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            for job in batch.ended_jobs():
+                name = f"{batch.jobs.index(job) + 1:02d}_{job.download_name}"
+                path = RESULT_CACHE.lookup(job.cache_key) if job.status == 'finished' else None
+                if path is None:
+                    failures.append(f"{name}: {job.error or 'no longer available'}")
+                    continue
+                entry_info = zipfile.ZipInfo(name, date_time=time.localtime(os.path.getmtime(path))[:6])
+                entry_info.file_size = os.path.getsize(path) # Lets zipfile decide on ZIP64 up front
+                with open(path, 'rb') as source, archive.open(entry_info, 'w') as entry:
+                    while True:
+                        chunk = source.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        entry.write(chunk)
+                        yield sink.drain()
+                yield sink.drain()
+            if failures:
+                archive.writestr('errors.txt', '\n'.join(failures) + '\n')
+        yield sink.drain()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f"attachment; filename=\"clips_{batch.id[:8]}.zip\""}
+    )
+
+# --- Trim previews: keyframe sprite sheet and waveform peaks ---
+# So the trim window can be chosen before paying for a download, /preview reads the
+# lowest-bitrate streams straight from their URLs: the video decoding only keyframes
+# (-skip_frame nokey) into one sprite sheet of small thumbnails, the audio downmixed
+# to a low-rate mono signal reduced to a peak array. Both are kept on disk per video.
+# Reading whole streams takes minutes for long videos, so previews are built in the
+# background like downloads: /preview answers 202 until the preview is ready.
+PREVIEW_DIR = os.environ.get('PREVIEW_DIR', os.path.join(TEMP_DIR, 'previews'))
+PREVIEW_MAX_ENTRIES = int(os.environ.get('PREVIEW_MAX_ENTRIES', 500))
+PREVIEW_THUMBNAILS = 100 # Upper bound of thumbnails in a sprite sheet
+PREVIEW_MIN_INTERVAL = 2.0 # Seconds between thumbnails, at least
+PREVIEW_TILE_SIZE = (160, 90)
+PREVIEW_COLUMNS = 10
+PREVIEW_WAVEFORM_POINTS = 1000
+PREVIEW_WAVEFORM_RATE = 2000 # Hz of the mono signal the peaks are taken from
+PREVIEW_CONCURRENCY = int(os.environ.get('PREVIEW_CONCURRENCY', 2)) # Max preview ffmpeg processes at once
+# Previews have their own slots and pools, so browsing never takes ffmpeg slots or stream
+# download workers away from download jobs
+PREVIEW_SLOTS = threading.BoundedSemaphore(PREVIEW_CONCURRENCY)
+PREVIEW_EXECUTOR = ThreadPoolExecutor(max_workers=PREVIEW_CONCURRENCY, thread_name_prefix='preview')
+PREVIEW_BUILD_EXECUTOR = ThreadPoolExecutor(max_workers=PREVIEW_CONCURRENCY, thread_name_prefix='preview-build')
+PREVIEW_BUILDS = OrderedDict() # key -> Future of a running build, or of a failed one until a poll reports it
+PREVIEW_BUILDS_LOCK = threading.Lock()
+PREVIEW_BUILD_STATS = {'leaders': 0, 'followers': 0}
+SHOWINFO_PTS_PATTERN = re.compile(r'Parsed_showinfo.*\bpts_time:\s*(-?[\d.]+)')
+
+class PreviewUnavailable(Exception):
+    """The video has no stream (or no duration) a preview can be built from."""
+
+def preview_key(url):
+    return hashlib.sha256(normalize_video_id(url).encode()).hexdigest()[:32]
+
+def lowest_bitrate_format(info, kind):
+    """The cheapest format with a video ('video') or audio ('audio') stream ffmpeg can read directly."""
+    codec = 'vcodec' if kind == 'video' else 'acodec'
+    candidates = [
+        f for f in info.get('formats') or []
+        if f.get('url') and f.get('protocol') in RANGE_FETCH_PROTOCOLS and f.get(codec) not in (None, 'none')
+    ]
+    if not candidates:
+        return None
+    # H.264 first for video, as every ffmpeg build can decode it
+    return min(candidates, key=lambda f: (
+        kind == 'video' and not (f.get('vcodec') or '').startswith(MP4_COPY_VIDEO_CODECS),
+        f.get('tbr') or f.get('abr') or float('inf')
+    ))
+
+def input_options(f):
+    return (['-headers', format_http_headers(f['http_headers'])] if f.get('http_headers') else []) + ['-i', f['url']]
+
+def render_sprite(f, duration, output_path):
+    """Tile keyframe thumbnails at least duration / PREVIEW_THUMBNAILS apart into output_path.
+
+    Returns the timestamps of the tiles in order.
+    """
+    interval = max(duration / PREVIEW_THUMBNAILS, PREVIEW_MIN_INTERVAL)
+    rows = -(-(int(duration / interval) + 1) // PREVIEW_COLUMNS)
+    width, height = PREVIEW_TILE_SIZE
+    filters = ','.join([
+        f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{interval:.3f})'",
+        'showinfo', # Logs the pts_time of each selected frame
+        f'scale={width}:{height}:force_original_aspect_ratio=decrease',
+        f'pad={width}:{height}:-1:-1',
+        f'tile={PREVIEW_COLUMNS}x{rows}'
+    ])
+    command = ['ffmpeg', '-skip_frame', 'nokey'] + input_options(f) + [
+        '-an', '-sn', '-vf', filters, '-frames:v', '1', '-update', '1', '-q:v', '5', '-y', output_path
+    ]
+    with PREVIEW_SLOTS, timed_stage('preview_sprite') as timing, tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr_file)
+        returncode, timing['cpu_seconds'] = wait_with_rusage(process)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors='replace')
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+        timing['bytes_out'] = os.path.getsize(output_path)
+    return [round(float(t), 3) for t in SHOWINFO_PTS_PATTERN.findall(stderr)][:PREVIEW_COLUMNS * rows]
+
+def waveform_peaks(f, duration):
+    """Peak amplitude (0-1) of PREVIEW_WAVEFORM_POINTS equal slices of the audio."""
+    samples_per_peak = max(1, -(-int(duration * PREVIEW_WAVEFORM_RATE) // PREVIEW_WAVEFORM_POINTS))
+    command = ['ffmpeg', '-v', 'error'] + input_options(f) + [
+        '-vn', '-ac', '1', '-ar', str(PREVIEW_WAVEFORM_RATE), '-f', 's16le', 'pipe:1'
+    ]
+    peaks = []
+    with PREVIEW_SLOTS, timed_stage('preview_waveform') as timing, tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            while True:
+                chunk = process.stdout.read(samples_per_peak * 2)
+                if len(chunk) < 2:
+                    break
+                samples = array.array('h', chunk[:len(chunk) // 2 * 2])
+                if sys.byteorder == 'big':
+                    samples.byteswap()
+                peaks.append(round(max(max(samples), -min(samples)) / 32768, 3))
+        finally:
+            process.stdout.close()
+            returncode, timing['cpu_seconds'] = wait_with_rusage(process)
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(returncode, command, stderr=stderr_file.read().decode(errors='replace'))
+    return peaks
+
+def build_preview(url, key):
+    info = get_cached_info(url)
+    duration = info.get('duration')
+    video, audio = lowest_bitrate_format(info, 'video'), lowest_bitrate_format(info, 'audio')
+    if not duration or (video is None and audio is None):
+        raise PreviewUnavailable("No preview can be made for this video.")
+
+    work_dir = os.path.join(PREVIEW_DIR, f"{key}.tmp-{os.getpid()}-{uuid.uuid4().hex}")
+    os.makedirs(work_dir)
+    try:
+        # The waveform is read while the sprite sheet renders, like the streams of a download
+        peaks_future = PREVIEW_EXECUTOR.submit(waveform_peaks, audio, duration) if audio else None
+        thumbnails = render_sprite(video, duration, os.path.join(work_dir, 'sprite.jpg')) if video else []
+        preview = {
+            'duration': duration,
+            'sprite': f"/previews/{key}/sprite.jpg" if video else None,
+            'tile_width': PREVIEW_TILE_SIZE[0],
+            'tile_height': PREVIEW_TILE_SIZE[1],
+            'columns': PREVIEW_COLUMNS,
+            'thumbnails': thumbnails, # Timestamp of each tile, in sprite order
+            'waveform': peaks_future.result() if peaks_future else [] # Peaks over equal slices of the duration
+        }
+        with open(os.path.join(work_dir, 'preview.json'), 'w') as fp:
+            json.dump(preview, fp)
+        try:
+            os.rename(work_dir, os.path.join(PREVIEW_DIR, key)) # Publish sprite and metadata together
+        except OSError:
+            pass # Another worker published the same preview first
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    prune_previews()
+    return preview
+
+def run_preview_build(url, key):
+    preview = build_preview(url, key)
+    with PREVIEW_BUILDS_LOCK:
+        PREVIEW_BUILDS.pop(key, None) # Published: later requests read it from disk
+    return preview
+
+def get_preview(url):
+    """Return the preview of a video, or None while it is built in the background.
+
+    A miss starts the build, once for concurrent requests. A failed build raises its
+    error on the next request for the video, which may then start it again.
+    """
+    key = preview_key(url)
+    preview_dir = os.path.join(PREVIEW_DIR, key)
+    try:
+        with open(os.path.join(preview_dir, 'preview.json')) as fp:
+            preview = json.load(fp)
+        os.utime(preview_dir) # Most recently used is pruned last
+        return preview
+    except FileNotFoundError:
+        pass
+    with PREVIEW_BUILDS_LOCK:
+        future = PREVIEW_BUILDS.get(key)
+        if future is None:
+            PREVIEW_BUILDS[key] = PREVIEW_BUILD_EXECUTOR.submit(run_preview_build, url, key)
+            PREVIEW_BUILD_STATS['leaders'] += 1
+            # Failures nobody came back for are dropped, oldest first
+            failed = [k for k, f in PREVIEW_BUILDS.items() if f.done()]
+            for failed_key in failed[:max(0, len(PREVIEW_BUILDS) - PREVIEW_MAX_ENTRIES)]:
+                del PREVIEW_BUILDS[failed_key]
+            return None
+        if not future.done():
+            PREVIEW_BUILD_STATS['followers'] += 1
+            return None
+        del PREVIEW_BUILDS[key]
+    return future.result()
+
+def preview_build_stats():
+    with PREVIEW_BUILDS_LOCK:
+        in_flight = sum(not f.done() for f in PREVIEW_BUILDS.values())
+        return dict(PREVIEW_BUILD_STATS, in_flight=in_flight)
+
+def prune_previews():
+    """Keep the PREVIEW_MAX_ENTRIES most recently used previews and drop unfinished ones of dead workers."""
+    entries = []
+    for name in os.listdir(PREVIEW_DIR):
+        path = os.path.join(PREVIEW_DIR, name)
+        if '.tmp-' in name:
+            owner = temp_owner(name)
+            if owner is None or not pid_alive(owner):
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            continue
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - PREVIEW_MAX_ENTRIES)]:
+        shutil.rmtree(path, ignore_errors=True)
+
+os.makedirs(PREVIEW_DIR, exist_ok=True)
+
+def preview_payload(url):
+    """Body and status of a /preview response (shared with the ASGI entry point)."""
+    try:
+        preview = get_preview(url)
+        if preview is None:
+            return {"status": "building"}, 202 # Poll again with the same request
+        return preview, 200
+    except PreviewUnavailable as e:
+        return {"error": str(e)}, 422
+    except yt_dlp.DownloadError as e:
+        return {"error": f"Could not get video info: {str(e)}"}, 500
+    except Exception as e:
+        print(f"Server error in preview: {e}")
+        return {"error": "Could not build a preview for this video."}, 500
+
+# Route to get the thumbnails sprite and waveform used to pick the trim window
+# (202 while the preview is being built)
+@app.route('/preview', methods=['POST'])
+def preview():
+    data = request.json
+    url = data.get('url')
+    if not url:
+        return jsonify({"error": "URL is required"}), 400
+    response_data, status = preview_payload(url)
+    return jsonify(response_data), status
+
+@app.route('/previews/<key>/sprite.jpg')
+def preview_sprite(key):
+    if not re.fullmatch(r'[0-9a-f]{32}', key):
+        return jsonify({"error": "Unknown preview"}), 404
+    path = os.path.join(PREVIEW_DIR, key, 'sprite.jpg')
+    if not os.path.exists(path):
+        return jsonify({"error": "Unknown preview"}), 404
+    return send_file(path, mimetype='image/jpeg', max_age=86400)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,205 @@
+"""ASGI entry point, served with `uvicorn asgi:application` or
+`gunicorn asgi:application -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker`.
+
+Under the sync workers every request holds a thread for as long as it lasts, so a few
+slow streams or extractions queue /get_video_info and even the static pages behind
+them. Here the long-running routes are served on the event loop instead:
+
+- /get_video_info and /preview await the yt-dlp extraction and the preview lookup,
+  which run on INFO_EXECUTOR (previews themselves are built in the background);
+- /jobs/<id>/stream follows the file app.StreamProducer writes, still under
+  app.FFMPEG_SLOTS so transcodes stay capped together with the job threads;
+- /jobs/<id>/file sends the cached file in chunks read off the loop.
+
+Every other route (the pages, /download, the job and batch APIs, /metrics) is handed
+to the Flask app, each request on a thread of its own.
+"""
+import asyncio
+import json
+import mimetypes
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+import app
+
+INFO_WORKERS = int(os.environ.get('ASGI_INFO_WORKERS', 32)) # Concurrent yt-dlp extractions
+WSGI_CONCURRENCY = int(os.environ.get('ASGI_WSGI_CONCURRENCY', 64)) # Flask requests running at once
+FILE_CHUNK_SIZE = 256 * 1024
+
+INFO_EXECUTOR = ThreadPoolExecutor(max_workers=INFO_WORKERS, thread_name_prefix='asgi-info')
+WSGI_APP = WsgiToAsgi(app.app)
+WSGI_SLOTS = asyncio.Semaphore(WSGI_CONCURRENCY)
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def start_response(send, status, content_type, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode())] + [(k.encode(), v.encode()) for k, v in headers]
+    })
+
+async def send_json(send, payload, status):
+    # Same encoding as Flask's jsonify
+    body = (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode()
+    await start_response(send, status, 'application/json', [('content-length', str(len(body)))])
+    await send({'type': 'http.response.body', 'body': body})
+
+async def url_payload(receive, send, payload_fn):
+    """Answer a JSON {"url": ...} request with payload_fn(url), run on INFO_EXECUTOR."""
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+    except ValueError:
+        data = None
+    url = data.get('url') if isinstance(data, dict) else None
+    if not url:
+        await send_json(send, {"error": "URL is required"}, 400)
+        return
+    payload, status = await asyncio.get_running_loop().run_in_executor(INFO_EXECUTOR, payload_fn, url)
+    await send_json(send, payload, status)
+
+async def video_info(scope, receive, send):
+    await url_payload(receive, send, app.video_info_payload)
+
+async def preview(scope, receive, send):
+    await url_payload(receive, send, app.preview_payload)
+
+async def job_file(scope, receive, send, job_id):
+    headers = dict(scope['headers'])
+    if b'range' in headers or b'if-range' in headers or b'if-none-match' in headers or b'if-modified-since' in headers:
+        # Partial and conditional requests are left to send_file
+        await flask(scope, receive, send)
+        return
+    job, error = app.finished_job(job_id)
+    if error:
+        await send_json(send, *error)
+        return
+    download_name = job.download_name or os.path.basename(job.file_path)
+    try:
+        # The open file survives an eviction from the result cache while it is sent
+        f = open(job.file_path, 'rb')
+    except FileNotFoundError:
+        await send_json(send, {"error": "The file for this job is no longer available"}, 410)
+        return
+
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    fields = {'bytes_out': 0}
+    outcome = 'aborted'
+    started = time.perf_counter()
+    try:
+        await start_response(send, 200, mimetypes.guess_type(download_name)[0] or 'application/octet-stream', [
+            ('content-length', str(os.fstat(f.fileno()).st_size)),
+            ('content-disposition', app.attachment_disposition(download_name))
+        ])
+        while not disconnected.done():
+            chunk = await loop.run_in_executor(None, f.read, FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            fields['bytes_out'] += len(chunk)
+        else:
+            return
+        await send({'type': 'http.response.body'})
+        outcome = 'ok'
+    finally:
+        f.close()
+        disconnected.cancel()
+        app.record_stage('send', time.perf_counter() - started, outcome, job,
+                         {'delivery': 'file', 'operations': job.operations}, fields)
+
+async def job_stream(scope, receive, send, job_id):
+    job, error = app.claim_stream_job(job_id)
+    if error:
+        await send_json(send, *error)
+        return
+
+    # ffmpeg writes into the result cache on a thread of its own, so the next identical
+    # request is a cache hit and a slow client does not hold its ffmpeg slot
+    cache_temp_path = app.RESULT_CACHE.temp_path(job.cache_key)
+    producer = app.StreamProducer(job, cache_temp_path)
+    loop = asyncio.get_running_loop()
+    outcome = 'aborted'
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    fields = {'bytes_out': 0}
+    started = time.perf_counter()
+    try:
+        with open(cache_temp_path, 'rb') as f:
+            await start_response(
+                send, 200, app.STREAM_MIMETYPES.get(job.params['download_format'], 'application/octet-stream'),
+                [('content-disposition', app.attachment_disposition(job.download_name))]
+            )
+            while not disconnected.done():
+                chunk = await loop.run_in_executor(None, producer.read, f)
+                if chunk is None:
+                    await asyncio.sleep(app.STREAM_POLL_INTERVAL)
+                    continue
+                if not chunk:
+                    break
+                fields['bytes_out'] += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            else:
+                return
+            fields['cpu_seconds'] = producer.cpu_seconds
+            outcome = producer.outcome
+            await send({'type': 'http.response.body'})
+    finally:
+        disconnected.cancel()
+        try:
+            # Client went away or ffmpeg failed: stop ffmpeg before dropping the inputs
+            await loop.run_in_executor(None, producer.finish)
+        finally:
+            stage_outcome = {'streamed': 'ok', 'failed': 'error'}.get(outcome, 'aborted')
+            app.record_stage('send', time.perf_counter() - started, stage_outcome, job,
+                             {'delivery': 'stream', 'operations': job.operations}, fields)
+            app.end_stream(job, outcome, cache_temp_path)
+
+async def flask(scope, receive, send):
+    # WsgiToAsgi runs every request on one shared thread unless each has a context of its own
+    async with WSGI_SLOTS, ThreadSensitiveContext():
+        await WSGI_APP(scope, receive, send)
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Fill the YoutubeDL pool before the first request, as post_fork does for the sync workers
+            await asyncio.get_running_loop().run_in_executor(INFO_EXECUTOR, app.YTDL_POOL.warm)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+ROUTES = [
+    ('POST', re.compile(r'/get_video_info'), video_info),
+    ('POST', re.compile(r'/preview'), preview),
+    ('GET', re.compile(r'/jobs/(?P<job_id>[^/]+)/file'), job_file),
+    ('GET', re.compile(r'/jobs/(?P<job_id>[^/]+)/stream'), job_stream)
+]
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+    if scope['type'] == 'http':
+        for method, pattern, handler in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match and scope['method'] == method:
+                await handler(scope, receive, send, **match.groupdict())
+                return
+    await flask(scope, receive, send)
@@ -0,0 +1,29 @@
+"""Helpers shared by the ffmpeg benchmarks: a generated fixture, child CPU time and timestamps."""
+import resource
+import subprocess
+
+
+def make_fixture(path, duration, size='1280x720', rate=30):
+    """Write an H.264 MP4 with a 2 s GOP and a sine audio track from ffmpeg's testsrc2/sine sources."""
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate={rate}:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', str(rate * 2), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-y', path
+    ], check=True)
+
+
+def children_cpu_seconds():
+    """User + system CPU time of all reaped child processes (the ffmpeg runs)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def seconds_to_time(seconds):
+    """HH:MM:SS for whole seconds, as /download takes them, else HH:MM:SS.mmm for ffmpeg."""
+    if seconds == int(seconds):
+        seconds = int(seconds)
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{int(seconds) // 3600:02d}:{int(seconds) % 3600 // 60:02d}:{seconds % 60:06.3f}"
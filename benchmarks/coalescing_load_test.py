@@ -0,0 +1,100 @@
+"""Load test for single-flight coalescing of identical /get_video_info and /download requests.
+
+Usage:
+    python app.py &
+    python benchmarks/coalescing_load_test.py http://localhost:5000 --url https://youtu.be/VIDEO_ID --clients 50
+
+All clients are released at the same moment (a barrier), first for /get_video_info and
+then for /download with identical parameters. The script then checks, from the
+counters in /cache_stats, that the server ran one upstream extraction and one
+transcode, and that every client received byte-identical output.
+"""
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def request_json(base_url, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(base_url + path, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=600) as response:
+        return json.loads(response.read())
+
+
+def fetch_bytes(base_url, path):
+    with urllib.request.urlopen(base_url + path, timeout=600) as response:
+        return response.read()
+
+
+def run_all(clients, fn):
+    """Run fn(i) on all clients at once and return the results in order."""
+    barrier = threading.Barrier(clients)
+
+    def task(i):
+        barrier.wait()
+        return fn(i)
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        return list(executor.map(task, range(clients)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_url')
+    parser.add_argument('--url', required=True, help="Video URL every client asks for")
+    parser.add_argument('--format', default='18')
+    parser.add_argument('--download-format', default='mp4', choices=['mp4', 'mp3'])
+    parser.add_argument('--start', default='00:00:10')
+    parser.add_argument('--end', default='00:00:20')
+    parser.add_argument('--clients', type=int, default=50)
+    args = parser.parse_args()
+    base_url = args.base_url.rstrip('/')
+
+    before = request_json(base_url, '/cache_stats')['single_flight']
+
+    started = time.perf_counter()
+    infos = run_all(args.clients, lambda i: request_json(base_url, '/get_video_info', {'url': args.url}))
+    print(f"/get_video_info: {args.clients} clients in {time.perf_counter() - started:.2f}s")
+    info_ok = all(info == infos[0] for info in infos)
+
+    payload = {
+        'url': args.url,
+        'format_id': args.format,
+        'download_format': args.download_format,
+        'start_time': args.start,
+        'end_time': args.end
+    }
+
+    def download(i):
+        job_id = request_json(base_url, '/download', payload)['job_id']
+        while True:
+            job = request_json(base_url, f"/jobs/{job_id}")
+            if job['status'] == 'failed':
+                raise RuntimeError(job['error'])
+            if job['status'] == 'finished':
+                return hashlib.sha256(fetch_bytes(base_url, f"/jobs/{job_id}/file")).hexdigest()
+            time.sleep(0.5)
+
+    started = time.perf_counter()
+    digests = run_all(args.clients, download)
+    print(f"/download: {args.clients} clients in {time.perf_counter() - started:.2f}s")
+
+    after = request_json(base_url, '/cache_stats')['single_flight']
+    extractions = after['info']['leaders'] - before['info']['leaders']
+    transcodes = after['download']['leaders'] - before['download']['leaders']
+    print(f"upstream extractions: {extractions} (followers: {after['info']['followers'] - before['info']['followers']})")
+    print(f"transcodes: {transcodes} (followers: {after['download']['followers'] - before['download']['followers']})")
+    print(f"identical info responses: {info_ok}")
+    print(f"identical files: {len(set(digests)) == 1} ({digests[0][:16]}...)")
+
+    if not info_ok or len(set(digests)) != 1 or extractions > 1 or transcodes > 1:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
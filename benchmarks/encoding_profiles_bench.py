@@ -0,0 +1,62 @@
+"""Encode speed, CPU cost and output size of the encoding profiles.
+
+Usage:
+    python benchmarks/encoding_profiles_bench.py [--sizes 640x360,1280x720,1920x1080] [--length 30] [--threads 2]
+
+For each size a 30 fps H.264 fixture with a sine audio track is generated with
+ffmpeg's testsrc2/sine sources. Every profile in app.ENCODING_PROFILES then makes
+the same precise MP4 cut through the planner /download uses and reports encode
+fps (output frames per wall second), CPU-seconds (user + system of the ffmpeg
+children) and output size. --threads caps -threads the way the adaptive profile
+does under load.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from bench_common import children_cpu_seconds, make_fixture, seconds_to_time
+
+
+FRAME_RATE = 30
+
+
+def run_profile(encoding, source, start, length, output_path):
+    job = app.DownloadJob({})
+    job.plan_stages(['transcode'])
+    command = app.plan_ffmpeg_pipeline(
+        [(source, None)], 'mp4', False, seconds_to_time(start), length, output_path, encoding=encoding
+    )
+    cpu_before = children_cpu_seconds()
+    started = time.perf_counter()
+    app.run_ffmpeg(command, job, 'transcode', length)
+    return time.perf_counter() - started, children_cpu_seconds() - cpu_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='640x360,1280x720,1920x1080', help="Comma-separated fixture sizes")
+    parser.add_argument('--start', type=float, default=2.5, help="Cut start in seconds (off-keyframe by default)")
+    parser.add_argument('--length', type=float, default=30.0, help="Cut length in seconds")
+    parser.add_argument('--threads', type=int, help="Cap -threads for every profile (default: ffmpeg's own)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        print(f"{'size':<10} {'profile':<10} {'fps':>8} {'wall s':>8} {'cpu s':>8} {'MB':>7}")
+        for size in args.sizes.split(','):
+            source = os.path.join(work_dir, f"fixture-{size}.mp4")
+            make_fixture(source, int(args.start + args.length) + 1, size, FRAME_RATE)
+            for name, profile in app.ENCODING_PROFILES.items():
+                encoding = profile._replace(threads=args.threads or profile.threads)
+                output_path = os.path.join(work_dir, f"{size}-{name}.mp4")
+                wall, cpu = run_profile(encoding, source, args.start, args.length, output_path)
+                size_mb = os.path.getsize(output_path) / 1e6
+                print(f"{size:<10} {name:<10} {args.length * FRAME_RATE / wall:>8.1f} {wall:>8.2f} {cpu:>8.2f} {size_mb:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Microbenchmark for app.rank_formats over large format lists.
+
+Usage:
+    yt-dlp -J URL > info.json
+    python benchmarks/format_ranking_bench.py [info.json ...] [--formats 500] [--iterations 2000]
+
+Recorded info dicts (yt-dlp -J output) are ranked as they are. Without any, a
+synthetic list with --formats entries is generated, mixing combined, video-only
+and audio-only formats across the usual heights and codecs, with about a third of
+them missing filesize so the tbr x duration estimate is exercised.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+VIDEO_CODECS = [('mp4', 'avc1.640028'), ('webm', 'vp9'), ('mp4', 'av01.0.08M.08')]
+AUDIO_CODECS = [('m4a', 'mp4a.40.2'), ('webm', 'opus')]
+HEIGHTS = [144, 240, 360, 480, 720, 1080, 1440, 2160]
+
+
+def synthetic_info(count, seed=0):
+    rng = random.Random(seed)
+    formats = []
+    for i in range(count):
+        kind = rng.random()
+        f = {'format_id': str(i), 'tbr': rng.uniform(50, 8000)}
+        if kind < 0.2:
+            f['ext'], f['acodec'] = rng.choice(AUDIO_CODECS)
+            f['vcodec'] = 'none'
+            f['abr'] = f['tbr']
+        else:
+            f['ext'], f['vcodec'] = rng.choice(VIDEO_CODECS)
+            f['height'] = rng.choice(HEIGHTS)
+            f['fps'] = rng.choice([24, 30, 60])
+            f['acodec'] = 'mp4a.40.2' if kind < 0.3 else 'none'
+        if rng.random() > 0.33:
+            f['filesize'] = int(f['tbr'] * 1000 / 8 * 600)
+        formats.append(f)
+    return {'id': 'synthetic', 'duration': 600, 'formats': formats}
+
+
+def bench(info, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        ranked = app.rank_formats(info)
+    elapsed = time.perf_counter() - started
+    return elapsed / iterations, ranked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help="yt-dlp -J output files")
+    parser.add_argument('--formats', type=int, default=500, help="Size of the synthetic format list")
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    infos = []
+    for path in args.files:
+        with open(path) as f:
+            infos.append(json.load(f))
+    if not infos:
+        infos.append(synthetic_info(args.formats))
+
+    print(f"{'video':<14} {'formats':>8} {'us/call':>9} {'us/format':>10}")
+    for info in infos:
+        per_call, ranked = bench(info, args.iterations)
+        count = len(info.get('formats') or [])
+        print(f"{str(info.get('id'))[:14]:<14} {count:>8} {per_call * 1e6:>9.1f} {per_call * 1e6 / max(count, 1):>10.3f}")
+        for entry in ranked:
+            print(f"    {entry['quality']:<16} {entry['id']:>6} {entry.get('audio_id', ''):>6} {entry['fileSize']}")
+
+
+if __name__ == '__main__':
+    main()
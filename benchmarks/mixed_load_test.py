@@ -0,0 +1,114 @@
+"""Request latency under mixed load, sync (gunicorn) versus async (ASGI) serving.
+
+Usage:
+    gunicorn app:app -c gunicorn.conf.py -b :8000 &
+    uvicorn asgi:application --port 8001 &
+    python benchmarks/mixed_load_test.py http://localhost:8000 http://localhost:8001 \\
+        --url https://youtu.be/VIDEO_ID --slow-clients 100 --duration 30
+
+For each server one clip is prepared through /download. Then --slow-clients clients
+download its file over and over at --read-rate KiB/s each, like slow mobile
+connections, while a probe requests the index page, /get_video_info (served from
+the info cache) and /jobs/<id> every --interval seconds. The probe latencies are
+reported per server and path, together with the number of slow downloads completed.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def request_json(base_url, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(base_url + path, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=600) as response:
+        return json.loads(response.read())
+
+
+def prepare_clip(base_url, args):
+    request_json(base_url, '/get_video_info', {'url': args.url}) # Fill the info cache
+    job_id = request_json(base_url, '/download', {
+        'url': args.url,
+        'format_id': args.format,
+        'download_format': 'mp4',
+        'start_time': args.start,
+        'end_time': args.end
+    })['job_id']
+    while True:
+        job = request_json(base_url, f"/jobs/{job_id}")
+        if job['status'] == 'failed':
+            raise RuntimeError(job['error'])
+        if job['status'] == 'finished':
+            return job_id
+        time.sleep(0.5)
+
+
+def slow_download(base_url, job_id, read_rate, stop):
+    """Fetch the clip file at read_rate KiB/s until stop is set; returns the downloads completed."""
+    completed = 0
+    while not stop.is_set():
+        with urllib.request.urlopen(f"{base_url}/jobs/{job_id}/file", timeout=600) as response:
+            while not stop.is_set():
+                if not response.read(read_rate * 1024):
+                    completed += 1
+                    break
+                time.sleep(1)
+    return completed
+
+
+def probe(base_url, path, payload=None):
+    started = time.perf_counter()
+    if payload is None:
+        with urllib.request.urlopen(base_url + path, timeout=600) as response:
+            response.read()
+    else:
+        request_json(base_url, path, payload)
+    return (time.perf_counter() - started) * 1000
+
+
+def run(base_url, args):
+    job_id = prepare_clip(base_url, args)
+    probes = {'/': None, '/get_video_info': {'url': args.url}, f"/jobs/{job_id}": None}
+    latencies = {path: [] for path in probes}
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=args.slow_clients) as executor:
+        downloads = [executor.submit(slow_download, base_url, job_id, args.read_rate, stop) for _ in range(args.slow_clients)]
+        time.sleep(2) # Let the slow clients connect
+        deadline = time.time() + args.duration
+        while time.time() < deadline:
+            for path, payload in probes.items():
+                latencies[path].append(probe(base_url, path, payload))
+            time.sleep(args.interval)
+        stop.set()
+        completed = sum(future.result() for future in downloads)
+
+    for path, samples in latencies.items():
+        samples.sort()
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        label = '/jobs/<id>' if path.startswith('/jobs/') else path
+        print(f"{base_url[:28]:<28} {label:<16} {statistics.median(samples):>9.1f} {p95:>9.1f} {samples[-1]:>9.1f} {completed:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_urls', nargs='+', help="Servers to compare, e.g. the sync one and the async one")
+    parser.add_argument('--url', required=True, help="Video URL to cut the test clip from")
+    parser.add_argument('--format', default='18')
+    parser.add_argument('--start', default='00:00:10')
+    parser.add_argument('--end', default='00:00:40')
+    parser.add_argument('--slow-clients', type=int, default=100)
+    parser.add_argument('--read-rate', type=int, default=64, help="KiB/s read by each slow client")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds of probing per server")
+    parser.add_argument('--interval', type=float, default=0.5, help="Seconds between probe rounds")
+    args = parser.parse_args()
+
+    print(f"{'server':<28} {'path':<16} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'downloads':>10}")
+    for base_url in args.base_urls:
+        run(base_url.rstrip('/'), args)
+
+
+if __name__ == '__main__':
+    main()
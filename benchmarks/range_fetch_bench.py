@@ -0,0 +1,75 @@
+"""Compare the full-download trim path against range fetch for short clips of long videos.
+
+Usage:
+    python benchmarks/range_fetch_bench.py URL [URL ...] --format 18 --start 00:30:00 --length 30
+
+For every URL the clip is produced twice through app.process_download, once with
+range_fetch off (download everything, then trim) and once with it on. The metadata
+is extracted once up front so both runs measure only the download + ffmpeg work.
+Bytes transferred are read from the network interface counters in /proc/net/dev,
+so run it on an otherwise idle machine (Linux only).
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from bench_common import seconds_to_time
+
+
+def received_bytes():
+    """Total bytes received on all non-loopback interfaces."""
+    total = 0
+    with open('/proc/net/dev') as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(':', 1)
+            if name.strip() != 'lo':
+                total += int(data.split()[0])
+    return total
+
+
+def run_once(url, args, range_fetch):
+    job = app.DownloadJob({
+        'url': url,
+        'format_id': args.format,
+        'download_format': args.download_format,
+        'is_video_only': args.video_only,
+        'start_time': args.start,
+        'end_time': seconds_to_time(app.time_to_seconds(args.start) + args.length),
+        'range_fetch': range_fetch
+    })
+    rx_before = received_bytes()
+    started = time.perf_counter()
+    output_path = app.process_download(job)
+    elapsed = time.perf_counter() - started
+    rx = received_bytes() - rx_before
+    output_size = os.path.getsize(output_path)
+    app.remove_work_dir(job)
+    return elapsed, rx, output_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--format', default='18', help="yt-dlp format_id to cut from (default: 18, 360p combined MP4)")
+    parser.add_argument('--video-only', action='store_true', help="The format is video-only and needs a separate audio stream")
+    parser.add_argument('--download-format', default='mp4', choices=['mp4', 'mp3'])
+    parser.add_argument('--start', default='00:30:00', help="Clip start (HH:MM:SS)")
+    parser.add_argument('--length', type=int, default=30, help="Clip length in seconds")
+    parser.add_argument('--runs', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'video':<14} {'mode':<6} {'seconds':>9} {'MB in':>9} {'MB out':>8}")
+    for url in args.urls:
+        info = app.get_cached_info(url) # Warm the metadata cache so extraction is not measured
+        for mode, range_fetch in (('full', False), ('range', True)):
+            for _ in range(args.runs):
+                elapsed, rx, output_size = run_once(url, args, range_fetch)
+                print(f"{info.get('id', url)[:14]:<14} {mode:<6} {elapsed:>9.2f} {rx / 1e6:>9.2f} {output_size / 1e6:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
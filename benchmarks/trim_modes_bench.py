@@ -0,0 +1,59 @@
+"""CPU cost of the MP4 trim modes (precise re-encode, smart cut, keyframe copy).
+
+Usage:
+    python benchmarks/trim_modes_bench.py [--input video.mp4] [--start 37.5] [--length 60]
+
+Without --input a 720p30 H.264 fixture with a 2 s GOP and a sine audio track is
+generated with ffmpeg's testsrc2/sine sources. Each mode cuts the same window
+through the functions /download uses and reports CPU-seconds (user + system of
+the ffmpeg children) per minute of output.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from bench_common import children_cpu_seconds, make_fixture, seconds_to_time
+
+
+def run_mode(mode, source, start, length, output_path):
+    job = app.DownloadJob({})
+    job.plan_stages(['transcode'])
+    sources = [(source, None)]
+    cpu_before = children_cpu_seconds()
+    started = time.perf_counter()
+    if not (mode == 'smart' and app.smart_cut(job, sources, (start, start + length), output_path, 'transcode')):
+        command = app.plan_ffmpeg_pipeline(sources, 'mp4', False, seconds_to_time(start), length, output_path, mode)
+        app.run_ffmpeg(command, job, 'transcode', length)
+    return time.perf_counter() - started, children_cpu_seconds() - cpu_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help="H.264 MP4 to cut (default: generated fixture)")
+    parser.add_argument('--fixture-duration', type=int, default=300)
+    parser.add_argument('--start', type=float, default=37.5, help="Cut start in seconds (off-keyframe by default)")
+    parser.add_argument('--length', type=float, default=60.0, help="Cut length in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        source = args.input
+        if not source:
+            source = os.path.join(work_dir, 'fixture.mp4')
+            print(f"Generating {args.fixture_duration}s fixture...")
+            make_fixture(source, args.fixture_duration)
+
+        print(f"{'mode':<10} {'wall s':>8} {'cpu s':>8} {'cpu s/out min':>14} {'MB':>7}")
+        for mode in app.TRIM_MODES:
+            output_path = os.path.join(work_dir, f"{mode}.mp4")
+            wall, cpu = run_mode(mode, source, args.start, args.length, output_path)
+            size = os.path.getsize(output_path) / 1e6
+            print(f"{mode:<10} {wall:>8.2f} {cpu:>8.2f} {cpu / (args.length / 60):>14.2f} {size:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
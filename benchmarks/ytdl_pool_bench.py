@@ -0,0 +1,68 @@
+"""Per-request latency of fresh YoutubeDL instances versus the worker's pooled ones.
+
+Usage:
+    python benchmarks/ytdl_pool_bench.py [URL ...] [--rounds 5]
+
+Without URLs only the instance setup is measured: creating a YoutubeDL and its
+YouTube extractor, as every request used to, against checking one out of the pool.
+With URLs each round also runs a metadata extraction (the work behind
+/get_video_info) both ways, bypassing the info cache, and reports the median
+latency per request and the difference.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+
+import app
+
+
+def fresh_request(url):
+    with yt_dlp.YoutubeDL(dict(app.YTDL_BASE_PARAMS, skip_download=True)) as ydl:
+        ydl.get_info_extractor('Youtube')
+        if url:
+            ydl.extract_info(url, download=False)
+
+
+def pooled_request(url):
+    with app.YTDL_POOL.checkout(skip_download=True) as ydl:
+        ydl.get_info_extractor('Youtube')
+        if url:
+            ydl.extract_info(url, download=False)
+
+
+def timed_ms(fn, url):
+    started = time.perf_counter()
+    fn(url)
+    return (time.perf_counter() - started) * 1000
+
+
+def report(label, fresh, pooled):
+    fresh_ms, pooled_ms = statistics.median(fresh), statistics.median(pooled)
+    print(f"{label[:24]:<24} {fresh_ms:>10.1f} {pooled_ms:>10.1f} {fresh_ms - pooled_ms:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='*')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    app.YTDL_POOL.warm(url=None)
+    print(f"{'request':<24} {'fresh ms':>10} {'pooled ms':>10} {'gain ms':>10}")
+    for url in [None] + args.urls:
+        fresh, pooled = [], []
+        for _ in range(args.rounds):
+            # Alternate so network and cache effects hit both sides equally
+            fresh.append(timed_ms(fresh_request, url))
+            pooled.append(timed_ms(pooled_request, url))
+        report(url or 'setup only', fresh, pooled)
+
+
+if __name__ == '__main__':
+    main()
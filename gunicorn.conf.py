@@ -0,0 +1,17 @@
+"""Gunicorn settings, loaded with `gunicorn -c gunicorn.conf.py app:app` (see Procfile.txt)."""
+import os
+
+# One worker only: jobs, coalesced downloads, batches, the result cache's byte index and
+# the metrics live in the process, so a second worker would 404 job polls routed to it.
+# WEB_CONCURRENCY (set by some hosts) is deliberately not read; scale with threads.
+workers = 1
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def post_fork(server, worker):
+    # Import the app in the new worker and fill its YoutubeDL pool before it accepts
+    # requests, so the first /get_video_info or /download does not pay for a cold start.
+    import app
+    app.YTDL_POOL.warm()
+    server.log.info("Worker %s: YoutubeDL pool warmed (%s)", worker.pid, app.YTDL_POOL.stats())
@@ -0,0 +1,104 @@
+"""Unit tests for the format ranking behind /get_video_info (compact_format, scores, rank_formats)."""
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def video(format_id, height, vcodec='avc1.640028', acodec='none', tbr=1000, **extra):
+    return dict(format_id=format_id, ext='mp4', height=height, fps=30, vcodec=vcodec, acodec=acodec, tbr=tbr, **extra)
+
+
+def audio(format_id, ext='m4a', acodec='mp4a.40.2', abr=128, **extra):
+    return dict(format_id=format_id, ext=ext, vcodec='none', acodec=acodec, abr=abr, tbr=abr, **extra)
+
+
+def entry(formats, quality, duration=100):
+    return next(e for e in app.rank_formats({'duration': duration, 'formats': formats}) if e['quality'] == quality)
+
+
+def test_missing_size_is_estimated_from_tbr_and_duration():
+    row = app.compact_format(video('18', 360, tbr=800), 100)
+    assert row.filesize == 800 * 1000 / 8 * 100
+    assert row.size_is_estimate
+
+    row = app.compact_format(video('18', 360, tbr=800, filesize=1234), 100)
+    assert row.filesize == 1234
+    assert not row.size_is_estimate
+
+
+def test_estimated_size_is_labelled_approximate():
+    formats = [video('18', 360, acodec='mp4a.40.2', tbr=800)]
+    assert entry(formats, 'Video / 360p')['fileSize'] == '~9.54 MB'
+
+    formats = [video('18', 360, acodec='mp4a.40.2', tbr=800, filesize=10 * 1024 * 1024)]
+    assert entry(formats, 'Video / 360p')['fileSize'] == '10.0 MB'
+
+
+def test_unknown_size_without_tbr_or_duration():
+    assert entry([video('18', 360, acodec='mp4a.40.2', tbr=None)], 'Video / 360p', duration=None)['fileSize'] == 'Unknown size'
+
+
+def test_combined_format_beats_video_only_at_same_height():
+    formats = [video('134', 360, tbr=2000), video('18', 360, acodec='mp4a.40.2', tbr=500), audio('140')]
+    chosen = entry(formats, 'Video / 360p')
+    assert chosen['id'] == '18'
+    assert chosen['is_video_only'] is False
+    assert 'audio_id' not in chosen
+
+    policy = dict(app.FORMAT_RANKING_POLICY, prefer_combined=False)
+    ranked = app.rank_formats({'duration': 100, 'formats': formats}, policy)
+    assert ranked[0]['id'] == '134'
+
+
+def test_h264_preferred_over_higher_bitrate_codecs():
+    formats = [video('248', 1080, vcodec='vp9', tbr=3000), video('137', 1080, tbr=2500), audio('140')]
+    assert entry(formats, 'Video / 1080p')['id'] == '137'
+
+
+def test_aac_paired_with_video_only_but_best_audio_offered_for_mp3():
+    formats = [video('137', 1080), audio('140', abr=128), audio('251', ext='opus', acodec='opus', abr=160)]
+    assert entry(formats, 'Video / 1080p')['audio_id'] == '140'
+    assert entry(formats, 'Audio / OPUS')['id'] == '251'
+
+
+def test_video_only_entry_pairs_audio_and_adds_its_size():
+    formats = [
+        video('137', 1080, filesize=30 * 1024 * 1024),
+        audio('140', filesize=2 * 1024 * 1024),
+        audio('139', abr=48, filesize=1024 * 1024)
+    ]
+    chosen = entry(formats, 'Video / 1080p')
+    assert chosen['is_video_only'] is True
+    assert chosen['audio_id'] == '140'
+    assert chosen['fileSize'] == '32.0 MB'
+
+    # An estimated audio size makes the sum an estimate too
+    formats[1].pop('filesize')
+    assert entry(formats, 'Video / 1080p')['fileSize'].startswith('~')
+
+
+def test_result_does_not_depend_on_format_order():
+    formats = [
+        video('136', 720, tbr=1500),
+        video('22', 720, acodec='mp4a.40.2', tbr=1200),
+        video('247', 720, vcodec='vp9', tbr=1800, filesize=50 * 1024 * 1024),
+        video('398', 720, vcodec='av01.0.05M.08', tbr=1100),
+        audio('140'),
+        audio('251', ext='opus', acodec='opus', abr=160, filesize=3 * 1024 * 1024)
+    ]
+    expected = app.rank_formats({'duration': 100, 'formats': formats})
+    for permutation in itertools.permutations(formats):
+        assert app.rank_formats({'duration': 100, 'formats': list(permutation)}) == expected
+
+
+def test_bitrate_then_smaller_size_break_ties():
+    formats = [
+        video('a', 480, acodec='mp4a.40.2', tbr=900, filesize=9 * 1024 * 1024),
+        video('b', 480, acodec='mp4a.40.2', tbr=900, filesize=8 * 1024 * 1024),
+        video('c', 480, acodec='mp4a.40.2', tbr=700, filesize=1024 * 1024)
+    ]
+    assert entry(formats, 'Video / 480p')['id'] == 'b'